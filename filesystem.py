@@ -14,21 +14,73 @@ import shutil
 import glob
 import stat
 import re
+import errno
+import hashlib
+import sqlite3
+import json
+import fnmatch
+import datetime
+import zlib
+import gzip
+import bz2
+import lzma
+import io
+import codecs
+import locale
+import tarfile
+import zipfile
+from array import array
+import time
+import threading
+import bisect
+import select
+import struct
+import ctypes
+import ctypes.util
+import itertools
+import multiprocessing
+import queue
+import functools
+import asyncio
+import weakref
+import mmap
+import tempfile
+import heapq
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 NEXT_DIRECTORY_CHARACTER = SEP = op.sep
 HOME = op.expanduser('~')
 assert op.exists(HOME), "HOME directory must exist"
+WORKERS = min(32, (os.cpu_count() or 1) + 4) # default size of thread pools (I/O bound work)
+CHUNK_SIZE = 1 << 20 # default block size of streaming reads
 
 class _Item(object):
     """Superclass for File and Directory classes"""
 
+    report = None # report of the last bulk operation (e.g. CopyReport)
+
     def __init__(self, path, quiet=False):
         path = abspath(path)
         self._path = path
         self._name = op.split(path)[-1]
-        if not op.exists(path) and not quiet:
+        if not quiet and cached_stat(path) is None:
             print("WARNING: {} still does not exist".format(self))
 
+    @classmethod
+    def from_entry(cls, entry):
+        """build the item from os.DirEntry (os.scandir) without extra stat calls"""
+        return cls.from_path(entry.path, entry.name)
+
+    @classmethod
+    def from_path(cls, path, name=None):
+        """build the item for the absolute path known to be of this type
+        without stat calls"""
+        item = cls.__new__(cls)
+        item._path = path
+        item._name = path2name(path) if name is None else name
+        return item
+
     def __repr__(self):
         return "_Item('{}')".format(self._path)
 
@@ -43,7 +95,10 @@ class _Item(object):
 
     def info(self):
         """return standard os.stat metadata"""
-        return info(self._path)
+        result = cached_stat(self._path)
+        if result is None:
+            raise FileNotFoundError("{} does not exist".format(self)) # no in python2.7
+        return result
 
     def what_is(self, quiet=True):
         return what_is(self._path, quiet=quiet)
@@ -52,18 +107,26 @@ class _Item(object):
         """remove existed"""
         assert self.exist(), "Cannot remove not existed {}".format(self)
         os.remove(self._path)
+        invalidate_stat(self._path)
 
     def move(self, directory):
         """move to a Directory"""
         assert self.exist(), "Cannot move not existed {}".format(self)
         new_path = concat(directory.path, self._name)
         shutil.move(self._path, new_path)
+        recursive = isinstance(self, Directory) # a file has nothing cached inside
+        invalidate_stat(self._path, recursive=recursive)
+        invalidate_stat(new_path, recursive=recursive)
         self._path = new_path
 
     def copy(self, new_path):
         """return copy with new path (including renaming)"""
         new_path = abspath(new_path)
-        shutil.copy(self._path, new_path)
+        if op.isdir(new_path):
+            new_path = concat(new_path, self._name)
+        copy_file(self._path, new_path)
+        shutil.copymode(self._path, new_path)
+        invalidate_stat(new_path)
         return Item(new_path)
 
     def copy_to(self, directory, new_name=None):
@@ -76,16 +139,19 @@ class _Item(object):
         """rename & update path"""
         new_path = self._path[:self._path.rfind(SEP) + 1] + new_name
         os.rename(self._path, new_path)
+        recursive = isinstance(self, Directory) # a file has nothing cached inside
+        invalidate_stat(self._path, recursive=recursive)
+        invalidate_stat(new_path, recursive=recursive)
         self._path = new_path
         self._name = new_name
 
     def exist(self):
         """check if the file exists"""
-        return op.exists(self._path)
+        return cached_stat(self._path) is not None
 
     def get_size(self):
         """return file size"""
-        return op.getsize(self._path)
+        return self.info().st_size
 
     def parent(self):
         """return parent Directory"""
@@ -97,6 +163,8 @@ class _Item(object):
         path = concat(directory.path, name)
         assert path != self._path, "Cannot create hard link with the same path '{}'".format(path)
         os.link(self._path, path)
+        invalidate_stat(self._path) # st_nlink changed
+        invalidate_stat(path)
         return Item(path)
 
     def symlink(self, directory=None, name=None):
@@ -106,6 +174,7 @@ class _Item(object):
         path = concat(directory.path, name)
         assert path != self._path, "Cannot create symbolic link with the same path '{}'".format(path)
         os.symlink(self._path, path)
+        invalidate_stat(path)
         return Item(path)
 
     def chown(self, uid, gid):
@@ -113,15 +182,19 @@ class _Item(object):
         NOTE (on the comp):
         0 -- root, 1000 -- vanfed, 1001 -- sauron"""
         os.chown(self._path, uid, gid)
+        invalidate_stat(self._path)
 
     def is_file(self):
-        return op.isfile(self._path)
+        result = cached_stat(self._path)
+        return result is not None and stat.S_ISREG(result.st_mode)
 
     def is_directory(self):
-        return op.isdir(self._path)
+        result = cached_stat(self._path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
 
     def is_link(self):
-        return op.islink(self._path)
+        result = cached_stat(self._path, follow_symlinks=False)
+        return result is not None and stat.S_ISLNK(result.st_mode)
 
     @property
     def name(self):
@@ -139,6 +212,9 @@ class _Item(object):
     def path(self, new_path):
         new_path = abspath(new_path)
         shutil.move(self._path, new_path)
+        recursive = isinstance(self, Directory) # a file has nothing cached inside
+        invalidate_stat(self._path, recursive=recursive)
+        invalidate_stat(new_path, recursive=recursive)
         self._name = op.split(new_path)[-1]
         self._path = new_path
 
@@ -162,11 +238,21 @@ class _Item(object):
 class File(_Item):
     """Class for fast editing text files and manipulating with them"""
 
+    _view = None # FileView, see view()
+
     def __init__(self, path, quiet=False):
         _Item.__init__(self, path, quiet)
         self._ext = self.get_ext() # without dot
         self.text_io_wrapper = None
 
+    @classmethod
+    def from_path(cls, path, name=None):
+        """build the file for the absolute path without stat calls"""
+        item = super(File, cls).from_path(path, name)
+        item._ext = item.get_ext()
+        item.text_io_wrapper = None
+        return item
+
     def __repr__(self):
         return "File('{}')".format(self._path)
 
@@ -174,17 +260,44 @@ class File(_Item):
         return "<File at '{}'>".format(self._path)
 
     def __iter__(self):
-        return iter(self.get_text())
+        """iterate over chars of the text file (streamed by chunks)"""
+        return itertools.chain.from_iterable(self.chunks())
 
     def __contains__(self, x):
         return x in self.get_text()
 
     def __getitem__(self, number):
+        """char (or slice of chars) of the text file; found through FileView
+        (without reading the whole file) if the text is utf-8 without '\\r'"""
+        if not isinstance(number, slice) or number.step in (None, 1):
+            view = self._char_view()
+            try:
+                if view.plain():
+                    return view[number]
+            finally:
+                view.release()
         return self.get_text()[number]
 
     def __setitem__(self, number, value):
-        text = self.get_text()
-        self.set_text(text[:number] + str(value) + text[number+1:])
+        """replace the char; in place through FileView if the text is utf-8
+        without '\\r' and the utf-8 length of the char is kept"""
+        value = str(value)
+        view = self._char_view(writable=True)
+        try:
+            if view.plain():
+                view[number] = value
+                invalidate_stat(self._path)
+                return
+        except (ValueError, IndexError):
+            pass
+        finally:
+            view.release()
+        with open(self._path) as file:
+            text = file.read()
+            newline = file.newlines if isinstance(file.newlines, str) else None # keep e.g. '\r\n'
+        with open(self._path, 'w', newline=newline) as file:
+            file.write(text[:number] + value + text[number+1:])
+        invalidate_stat(self._path)
 
     def __len__(self):
         """len of text (chars) in text file"""
@@ -192,26 +305,78 @@ class File(_Item):
 
     def __iadd__(self, s):
         self.append(s)
+        return self
 
-    def charlen(self):
+    def charlen(self, encoding=None):
         """len of text (chars) in text file"""
         assert self.exist(), "not existed {} has no len".format(self)
-        return len(open(self._path).read())
+        return sum(map(len, self.chunks(encoding=encoding)))
 
-    def strlen(self):
+    def strlen(self, encoding=None):
         """number of strings in text file"""
         assert self.exist(), "not existed {} has no strlen".format(self)
-        return len(open(self._path).readlines())
+        number = 0
+        last = '\n'
+        for chunk in self.chunks(encoding=encoding):
+            number += chunk.count('\n')
+            last = chunk[-1]
+        return number + (last != '\n')
+
+    def lines(self, encoding=None, binary=False):
+        """iterate over strings of the file (with line ends) without loading it whole;
+        binary=True yields bytes"""
+        if binary:
+            with open(self._path, 'rb') as file:
+                for line in file:
+                    yield line
+        else:
+            with open(self._path, 'r', encoding=encoding) as file:
+                for line in file:
+                    yield line
+
+    def chunks(self, size=CHUNK_SIZE, encoding=None, binary=False):
+        """iterate over consecutive pieces of the text file, 'size' chars each
+        (bytes if binary=True), without loading it whole"""
+        mode = 'rb' if binary else 'r'
+        with open(self._path, mode, encoding=None if binary else encoding) as file:
+            chunk = file.read(size)
+            while chunk:
+                yield chunk
+                chunk = file.read(size)
 
     def create(self):
         """create empty text file"""
         self.set_text('')
 
-    def unpack_archive(self, extract_dirpath=None, format=None):
+    def unpack_archive(self, extract_dirpath=None, format=None, workers=None):
         """possible formats: zip, tar, gztar, and similar...
-        (shutil.get_unpack_formats() list all)"""
-        shutil.unpack_archive(self._path, extract_dir=extract_dirpath, format=format)
-        return Directory(cwd() if extract_dirpath is None else extract_dirpath)
+        (shutil.get_unpack_formats() list all);
+        zip and tar archives are extracted concurrently (see extract_archive(),
+        self.report is the ArchiveReport)"""
+        extract_dirpath = cwd() if extract_dirpath is None else abspath(extract_dirpath)
+        if format in (None, 'zip', 'tar', 'gztar', 'bztar', 'xztar'):
+            self.report = extract_archive(self._path, extract_dirpath, workers=workers)
+        else:
+            shutil.unpack_archive(self._path, extract_dir=extract_dirpath, format=format)
+        return Directory(extract_dirpath)
+
+    def archive(self):
+        """return read-only ArchiveDirectory view of the zip/tar file
+        (member index is built once and cached)"""
+        return ArchiveDirectory(archive_index(self._path))
+
+    def view(self, writable=False, step=1024):
+        """return new memory-mapped FileView of the file (close it or use
+        it as context manager)"""
+        return FileView(self._path, writable, step)
+
+    def _char_view(self, writable=False):
+        """FileView for indexing: its char index is kept between calls
+        (released views hold no file descriptor)"""
+        view = self._view
+        if view is None or (writable and not view.writable):
+            view = self._view = FileView(self._path, writable)
+        return view.reopen()
 
     def clear(self):
         """empty existed text file"""
@@ -239,15 +404,28 @@ class File(_Item):
             text = file.read()
         return text
 
-    def set_text(self, new_text, encoding=None):
-        """set text of the text file"""
+    def set_text(self, new_text, encoding=None, atomic=False, fsync=False):
+        """set text of the text file; if atomic the text is written to a temporary
+        sibling which then replaces the file (readers see old or new text, never
+        a torn one); if fsync the data (and the rename) is flushed to disk"""
+        if atomic:
+            write_atomic(self._path, new_text, encoding=encoding, fsync=fsync)
+            return
         with open(self._path, 'w', encoding=encoding) as file:
             file.write(new_text)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        invalidate_stat(self._path)
 
     def print_text(self):
         """print text of the text file"""
         print(self.get_text())
 
+    def get_hash(self, algorithm='sha256'):
+        """return hex digest of the file content"""
+        return file_hash(self._path, algorithm=algorithm)
+
     def get_ext(self):
         """return file extension without dot"""
         return op.splitext(self._name)[1][1:]
@@ -261,14 +439,8 @@ class File(_Item):
         where 'rw' means 'read and write', 'r' means 'read only',
         'w' means 'write only', '---' means 'no access',
         'x' means 'executable. Order: '-<owner><group><other>' -- Unix 'ls -l'-like syntax."""
-        # + see http://www.computerhope.com/unix/uchmod.htm
-        mode = mode[1:]
-        ugo = [0, 0, 0] # oct 0o000
-        corresponds = {'-': 0, 'x': 1, 'w': 2, 'r': 4}
-        for i, m in enumerate([mode[i: i + 3] for i in range(0, len(mode), 3)]):
-            for ch in m:
-                ugo[i] += corresponds[ch]
-        os.chmod(self._path, int("{}{}{}".format(*ugo), 8))
+        os.chmod(self._path, file_mode(mode))
+        invalidate_stat(self._path)
 
     def __extract(self, directory=None):
         """TODO:
@@ -290,9 +462,18 @@ class File(_Item):
             results = []
             while result != -1:
                 results.append(result)
-                result = text.find(string, result)
+                result = text.find(string, result + (len(string) or 1))
             return results
 
+    def search(self, patterns, line_numbers=False, encoding='utf-8'):
+        """iterate lazily over (<byte offset>, <pattern>) of every occurrence
+        in the memory-mapped file, nothing is decoded;
+        'patterns' is a literal (str or bytes), an iterable of literals
+        (all searched at once by Aho-Corasick automaton, overlapping occurrences included)
+        or a compiled regular expression (then <pattern> is the matched bytes);
+        if line_numbers yield (<byte offset>, <line number from 1>, <pattern>)"""
+        return search(self._path, patterns, line_numbers=line_numbers, encoding=encoding)
+
     def __crop(self, pairs, coherent=False, quiet=True):
         """cut specified text from the file;
          'pairs' =  iterator of (start, end);
@@ -332,92 +513,26 @@ class File(_Item):
     def __remove(self, args, quiet=True):
         """remove strings;
         'args' = iterator of ('<string>' [, <number of removings>])"""
-        text = self.get_text()
-        for arg in args:
-            if isinstance(arg[0], str):
-                string = arg[0]
-            else:
-                position = arg[0]
-            if len(arg) == 2:
-                number = -arg[1]
-                if not isinstance(number, int):
-                    if not quiet:
-                        print("Wrong number format: '{0}'. Replaced with 'None'.".format(number))
-                    number = None
-            else:
-                number = None
-            if isinstance(arg[0], str):
-                position = text.find(string)
-            if not quiet and position == -1:
-                    print("There is not at all '{0}'.".format(string))
-            while position != -1 and (number is None or number < 0):
-                if not quiet:
-                    print("Removed {0} in {1} position.".format(string, position))
-                text = text[:position] + text[position + len(string):]
-                if number != None:
-                    number += 1
-                position = text.find(string, position)
-            if not quiet and position != -1:
-                print("There are at least one more matches with '{0}'.".format(string))
-        self.set_text(text)
+        self.rewrite([(arg[0], '') + tuple(arg[1:2]) for arg in args], quiet=quiet)
 
     def __replace(self, pairs, quiet=True):
         """replace old strings (not whole) with new ones in the file;
         'pairs' = iterator of ('<old>', '<new>' [, <number of replacings>])"""
-        text = self.get_text()
-        for pair in pairs:
-            (old, new) = (pair[0], pair[1])
-            if len(pair) == 3:
-                number = -pair[2]
-                if not isinstance(number, int):
-                    if not quiet:
-                        print("Wrong number format: '{0}'. Replaced with 'None'.".format(number))
-                    number = None
-            else:
-                number = None
-            old_position = text.find(old)
-            if not quiet and old_position == -1:
-                    print("There is not at all '{0}'.".format(old))
-            while old_position != -1 and (number is None or number < 0):
-                if not quiet:
-                    print("Replaced {0} with {1} in {2} position.".format(old, new, old_position))
-                text = text[:old_position] + new + text[old_position + len(old):]
-                if number != None:
-                    number += 1
-                old_position = text.find(old, old_position + len(new))
-            if not quiet and old_position != -1:
-                print("There are at least one more matches with '{0}'.".format(old))
-        self.set_text(text)
+        self.rewrite(pairs, quiet=quiet)
 
     def __replace_strings(self, pairs, quiet=True):
         """replace old whole strings with new ones in the file;
         'pairs' = iterator of ('<old>', '<new>' [, <number of replacings>])"""
-        text = self.get_text()
+        rules = []
         for pair in pairs:
-            (old, new) = (pair[0], pair[1])
-            if len(pair) == 3:
-                number = -pair[2]
-                if not isinstance(number, int):
-                    if not quiet:
-                        print("Wrong number format: '{0}'. Replaced with 'None'.".format(number))
-                    number = None
-            else:
-                number = None
-            old_position = text.find(old)
-            start = text.rfind('\n', 0, old_position) + 1
-            end = text.find('\n', old_position)
-            if not quiet and old_position == -1:
-                    print("There is not at all '{0}'.".format(old))
-            while old_position != -1 and (number is None or number < 0):
-                if not quiet:
-                    print("Replaced {0} with {1} at {2} string.".format(text[start:end], new, text[:start].count('\n')+1))
-                text = text[:start] + new + text[end:]
-                if number != None:
-                    number += 1
-                old_position = text.find(old, end)
-            if not quiet and old_position != -1:
-                print("There are at least one more matches with '{0}'.".format(old))
-        self.set_text(text)
+            line = re.compile('^.*' + re.escape(pair[0]) + '.*$', re.MULTILINE)
+            rules.append((line, (lambda new: lambda match: new)(pair[1])) + tuple(pair[2:3]))
+        self.rewrite(rules, quiet=quiet)
+
+    def rewrite(self, rules, encoding=None, window=1 << 12, quiet=True):
+        """replace by the rules in one pass over the streamed file, see rewrite();
+        return list of numbers of replacings for every rule"""
+        return rewrite(self._path, rules, encoding=encoding, window=window, quiet=quiet)
 
     def insert(self, new_text, position):
         """insert text from the position into the text file"""
@@ -425,11 +540,16 @@ class File(_Item):
         text = text[:position] + new_text + text[position:]
         self.set_text(text)
 
-    def append(self, next_text):
+    def append(self, next_text, encoding=None):
         """add the text to the end of the text file"""
-        text = self.get_text()
-        text += next_text
-        self.set_text(text)
+        with open(self._path, 'a', encoding=encoding) as file:
+            file.write(next_text)
+        invalidate_stat(self._path)
+
+    def writer(self, buffer_size=1 << 16, encoding=None, fsync=False):
+        """return FileWriter: buffered append session, use as context manager:
+        with file.writer() as w: w.append(...)"""
+        return FileWriter(self, buffer_size=buffer_size, encoding=encoding, fsync=fsync)
 
     def __find_and_apply(self, string, func): #TODO: check
         """TODO:
@@ -509,9 +629,266 @@ class File(_Item):
     def text(self, new_text):
         self.set_text(new_text)
 
+class FileWriter(object):
+    """Append session for a File: texts are collected in memory and written
+    to the end of the file when 'buffer_size' chars are collected
+    (and on flush/close); if fsync the file is fsync'ed once on close"""
+
+    def __init__(self, file, buffer_size=1 << 16, encoding=None, fsync=False):
+        self._file = file
+        self._buffer = []
+        self._buffered = 0
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self._io = open(file.path, 'a', encoding=encoding)
+
+    def __repr__(self):
+        return "FileWriter({!r})".format(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, text):
+        """add the text to the end of the file"""
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    write = append
+
+    def insert(self, text, position=None):
+        """only insertion at the end (position=None) is supported in a session"""
+        if position is not None:
+            raise ValueError("FileWriter can insert only at the end of the file")
+        self.append(text)
+
+    def flush(self):
+        """write the collected texts to the file"""
+        if self._buffer:
+            self._io.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._io.flush()
+
+    def close(self):
+        if self._io.closed:
+            return
+        self.flush()
+        if self.fsync:
+            os.fsync(self._io.fileno())
+        self._io.close()
+        invalidate_stat(self._file.path)
+
+    @property
+    def closed(self):
+        return self._io.closed
+
+class FileView(object):
+    """Memory-mapped view of a utf-8 file: view.bytes[a:b] slices the mapping
+    directly, view[i] and view[a:b] are chars found through a sparse index
+    of byte offsets of every <step>-th char; assignments of the same byte
+    length are written in place into the mapping (and so into the file)"""
+
+    def __init__(self, path, writable=False, step=1024):
+        self.path = abspath(path)
+        self.writable = writable
+        self.step = step
+        self._file = self._map = self._signature = None
+        self._reset()
+        self.reopen()
+
+    def _reset(self):
+        self._offsets = array('Q', [0]) # byte offset of char number i * step
+        self._length = None # in chars, when known
+        self._translated = None # whether there is '\r' (changed by universal newlines)
+
+    def reopen(self):
+        """map the file again after release(), the char index is kept
+        if the file was not changed meanwhile"""
+        if self._file is not None:
+            return self
+        self._file = open(self.path, 'r+b' if self.writable else 'rb')
+        signature = self._fstat()
+        if signature != self._signature:
+            self._reset()
+            self._signature = signature
+        self._size = signature[2]
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), 0, access=access) if self._size else None
+        return self
+
+    def __repr__(self):
+        return "<FileView of '{}': {} bytes>".format(self.path, self._size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        """number of chars"""
+        while self._length is None:
+            self._next_checkpoint()
+        return self._length
+
+    def __getitem__(self, key):
+        start, stop = self._bounds(key)
+        return self._data(start, stop).decode('utf-8')
+
+    def __setitem__(self, key, value):
+        if not self.writable:
+            raise TypeError("read-only view, use File.view(writable=True)")
+        start, stop = self._bounds(key)
+        data = value.encode('utf-8')
+        if len(data) != stop - start:
+            raise ValueError("in-place write has to keep byte length ({} != {})".format(len(data), stop - start))
+        chars = len(self._data(start, stop).decode('utf-8', 'surrogateescape'))
+        self._map[start:stop] = data
+        self._translated = None
+        if len(value) != chars:
+            # offsets of chars after the first replaced one are shifted
+            first = (key.start or 0) if isinstance(key, slice) else key
+            del self._offsets[first // self.step + 1 if first >= 0 else 1:]
+            self._length = None
+        self._signature = self._fstat()
+
+    def _fstat(self):
+        result = os.fstat(self._file.fileno())
+        return (result.st_dev, result.st_ino, result.st_size, result.st_mtime_ns)
+
+    def _data(self, start, stop):
+        return self._map[start:stop] if self._map is not None else b''
+
+    def _advance(self, offset, number):
+        """return (byte offset of the char <number> chars after the one at offset, None)
+        or (None, <number of chars left>) if there are not enough chars"""
+        window = self._data(offset, offset + 4 * number)
+        if window.isascii():
+            return (offset + number, None) if len(window) >= number else (None, len(window))
+        # 4 * number bytes hold at least <number> whole chars, an undecodable
+        # byte counts as a char (like a cut char at the end of the file)
+        text = window.decode('utf-8', 'surrogateescape')
+        if len(text) < number:
+            return None, len(text)
+        return offset + len(text[:number].encode('utf-8', 'surrogateescape')), None
+
+    def _next_checkpoint(self):
+        offset, left = self._advance(self._offsets[-1], self.step)
+        if offset is None:
+            self._length = (len(self._offsets) - 1) * self.step + left
+        else:
+            self._offsets.append(offset)
+
+    def offset(self, number):
+        """byte offset of the char with the number (len(view) -- end of the file)"""
+        if number < 0:
+            number += len(self)
+        checkpoint, rest = divmod(number, self.step)
+        while len(self._offsets) <= checkpoint and self._length is None:
+            self._next_checkpoint()
+        if number < 0 or checkpoint >= len(self._offsets):
+            raise IndexError("char index out of range")
+        offset, left = self._advance(self._offsets[checkpoint], rest) if rest else (self._offsets[checkpoint], None)
+        if offset is None:
+            raise IndexError("char index out of range")
+        return offset
+
+    def _bounds(self, key):
+        """(start, stop) byte offsets of the char or slice of chars"""
+        if not isinstance(key, slice):
+            start = self.offset(key)
+            if start >= self._size:
+                raise IndexError("char index out of range")
+            return start, self.offset((key if key >= 0 else key + len(self)) + 1)
+        if key.step not in (None, 1):
+            raise ValueError("only contiguous slices are supported")
+        def clamp(number, default):
+            if number is None:
+                return default
+            try:
+                return self.offset(max(number, -len(self)) if number < 0 else number)
+            except IndexError:
+                return self._size
+        start, stop = clamp(key.start, 0), clamp(key.stop, self._size)
+        return start, max(start, stop)
+
+    def valid(self):
+        """whether the file was not replaced or changed besides the view"""
+        try:
+            result = os.stat(self.path)
+        except OSError:
+            return False
+        return (result.st_dev, result.st_ino, result.st_size, result.st_mtime_ns) == self._signature
+
+    def plain(self):
+        """whether chars of the view are chars of File.get_text(): the text
+        has no '\\r' (translated by universal newlines) and the default
+        encoding is utf-8"""
+        if self._translated is None:
+            self._translated = self._map is not None and self._map.find(b'\r') != -1
+        return not self._translated and codecs.lookup(locale.getpreferredencoding(False)).name == 'utf-8'
+
+    def flush(self):
+        """write changes of the mapping to disk"""
+        if self._map is not None:
+            self._map.flush()
+
+    def release(self):
+        """unmap and close the file but keep the char index, see reopen()"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self.release()
+
+    @property
+    def closed(self):
+        return self._file is None
+
+    @property
+    def bytes(self):
+        """bytes of the file, sliced (and assigned with the same length) in place"""
+        return _ByteView(self)
+
+class _ByteView(object):
+    """bytes of a FileView"""
+
+    def __init__(self, view):
+        self._view = view
+
+    def __len__(self):
+        return self._view._size
+
+    def __getitem__(self, key):
+        if self._view._map is None:
+            return b''[key]
+        return self._view._map[key]
+
+    def __setitem__(self, key, value):
+        view = self._view
+        if not view.writable:
+            raise TypeError("read-only view, use File.view(writable=True)")
+        if view._map is None:
+            raise IndexError("mmap index out of range")
+        view._map[key] = value
+        view._reset()
+        view._signature = view._fstat()
+
 class Directory(_Item):
     """Class for fast manipulating with directories"""
 
+    _watch = None # DirectoryWatch, see watch()
+    _listing = None # Listing, see listing()
+
     def __init__ (self, path, quiet=False):
         _Item.__init__(self, path, quiet)
 
@@ -523,13 +900,22 @@ class Directory(_Item):
 
     def __len__(self):
         """return number of items inside"""
-        return len(self.ls())
+        if self.watching():
+            return len(self._watch)
+        return len(self.listing())
 
     def __iter__(self):
-        return iter(self.get_items())
+        return self.scan()
 
     def __contains__(self, x):
-        return x in self.get_items()
+        """check if the item (or the name) is inside"""
+        if isinstance(x, _Item):
+            if op.dirname(x.path) != self._path:
+                return False
+            x = x.name
+        if self.watching():
+            return x in self._watch
+        return SEP not in x and op.lexists(concat(self._path, x))
 
     def __truediv__(self, name):
         return self.down(name)
@@ -559,102 +945,171 @@ class Directory(_Item):
 
     def get_items(self):
         """return list of the items inside"""
-        return [Item(concat(self._path, name)) for name in os.listdir(self._path)]
+        return list(self.scan())
+
+    def scan(self):
+        """iterate over the items inside (os.scandir, no stat per item)"""
+        return scan(self._path)
 
     def get_names(self):
         """return list of name of the items inside"""
         return os.listdir(self._path)
 
-    def get_size(self):
-        """return size. Recursive a-la $ sudo du -sh <self._path>"""
-        size = op.getsize(self._path)
-        for path in self.get_paths():
-            size += Item(path).get_size()
-        return size
+    def get_size(self, apparent=True, workers=None):
+        """return size. Recursive a-la $ sudo du -sh <self._path>
+        (hard links are counted once, symlinks are not followed);
+        apparent=False counts allocated blocks instead of st_size"""
+        return du(self._path, apparent=apparent, workers=workers)[self._path]
+
+    def du(self, apparent=True, workers=None, quiet=True):
+        """return dict {<directory path>: <total size>} for every directory inside
+        (including this one), see du()"""
+        return du(self._path, apparent=apparent, workers=workers, quiet=quiet)
 
     def create(self):
         """create empty directory"""
         os.mkdir(self._path)
+        invalidate_stat(self._path)
 
-    def make_archive(self, base_name=None, format='zip', root_dirpath=None, owner=None, group=None):
-        """'base_name' is the name of the file to create, minus any format-specific extension
-        (by default the directory name)
+    def make_archive(self, base_name=None, format='zip', root_dirpath=None, owner=None, group=None,
+            workers=None, level=6):
+        """'base_name' is the path of the file to create, minus any format-specific extension
+        (by default the directory path, i.e. the archive is created next to the directory)
         'format' is the archive format: one of "zip", "tar", "bztar" or "gztar"
         (shutil.get_archive_formats() returns all)
         'root_dir' is a directory that will be the root directory of the
-        archive; ie. we typically chdir into 'root_dir' before creating the archive.
-        'root_dir' default to the current directory.
+        archive, paths inside are relative to it.
+        'root_dir' default to the parent directory.
         'owner' and 'group' are used when creating a tar archive. By default,
         uses the current owner and group.
+        "gztar" is compressed on 'workers' threads (see make_tar_gz(),
+        self.report is the ArchiveReport).
 
         Returns the File of the archive file.
         """
-        if base_name is None: base_name = self._name
-        name = shutil.make_archive(base_name=base_name, format=format, root_dir=root_dirpath, base_dir=self._path, owner=owner, group=group)
-        return File(concat(cwd(), name))
+        base_name = self._path if base_name is None else abspath(base_name)
+        root_dirpath = op.dirname(self._path) if root_dirpath is None else abspath(root_dirpath)
+        base_dir = op.relpath(self._path, root_dirpath)
+        if format == 'gztar' and owner is None and group is None:
+            self.report = make_tar_gz(self._path, base_name + '.tar.gz', arcname=base_dir,
+                level=level, workers=workers)
+            return File(base_name + '.tar.gz')
+        name = shutil.make_archive(base_name=base_name, format=format, root_dir=root_dirpath, base_dir=base_dir, owner=owner, group=group)
+        return File(abspath(name))
 
     def group(self):
         """return a group of the items inside"""
         return Group.from_directory(self)
 
-    def copy(self, new_path):
-        """return copy with new path (including renaming)"""
+    def grep(self, patterns, recursive=True, workers=None, limit=None, binary=False,
+            line_numbers=True, encoding='utf-8'):
+        """search the patterns in the files inside (all the tree if recursive)
+        on a process pool, see grep()"""
+        if recursive:
+            files = ((entry.path, entry.stat(follow_symlinks=False).st_size)
+                for entry in walk_entries(self._path) if entry.is_file(follow_symlinks=False))
+        else:
+            files = ((entry.path, entry.stat().st_size)
+                for entry in os.scandir(self._path) if entry.is_file())
+        return grep(files, patterns, workers=workers, limit=limit, binary=binary,
+            line_numbers=line_numbers, encoding=encoding)
+
+    def copy(self, new_path, workers=None, symlinks=False):
+        """return copy with new path (including renaming);
+        files are copied concurrently in kernel, see copy_tree()
+        (self.report is the CopyReport, BulkError raised if something failed)"""
         new_path = abspath(new_path)
         if not self.is_link():
-            shutil.copytree(self._path, new_path)
+            self.report = copy_tree(self._path, new_path, workers=workers, symlinks=symlinks)
+            self.report.raise_errors()
         else:
             shutil.copy(self._path, new_path)
+        invalidate_stat(new_path, recursive=True)
         return Directory(new_path)
 
-    def copy_to(self, directory, new_name=None):
+    def copy_to(self, directory, new_name=None, workers=None, symlinks=False):
         """return copy to a Directory"""
         new_name = new_name or self._name
         new_path = concat(directory.path, new_name)
-        return self.copy(new_path)
-
-    def delete(self):
-        """recursively remove the directory"""
+        return self.copy(new_path, workers=workers, symlinks=symlinks)
+
+    def duplicates(self, cache_path=None, link=False, workers=None, min_size=1, quiet=True):
+        """return list of Groups of duplicate files in the tree, see find_duplicates()"""
+        files = (entry.path for entry in walk_entries(self._path) if entry.is_file(follow_symlinks=False))
+        return find_duplicates(files, cache_path=cache_path, link=link, workers=workers,
+            min_size=min_size, quiet=quiet)
+
+    def query(self):
+        """return lazy GroupQuery over the items inside, e.g.
+        directory.query().ext('py').larger_than(1 << 20).recursive().group()"""
+        return GroupQuery(self._path)
+
+    def index(self, db_path=None, refresh=True):
+        """return TreeIndex of the tree (stored in SQLite database at 'db_path')"""
+        tree_index = TreeIndex(self._path, db_path)
+        if refresh:
+            tree_index.refresh()
+        return tree_index
+
+    def sync_to(self, target, checksum=False, delete=False, dry_run=False, workers=None, quiet=True,
+            manifest=None):
+        """mirror the directory into the target Directory (or path) copying only
+        new and changed files (skipping unchanged directories if 'manifest'),
+        see sync_tree(); return SyncPlan"""
+        target_path = target.path if isinstance(target, _Item) else target
+        return sync_tree(self._path, target_path, checksum=checksum, delete=delete,
+            dry_run=dry_run, workers=workers, quiet=quiet, manifest=manifest)
+
+    def delete(self, workers=None, progress=None):
+        """recursively remove the directory (concurrently, see delete_tree())"""
         if not self.is_link():
-            shutil.rmtree(self._path)
+            delete_tree(self._path, workers=workers, progress=progress)
         else:
             os.remove(self._path)
+        invalidate_stat(self._path, recursive=True)
 
     def chmod(self, mode):
         """for example: mode='-cal-al--l' (3 '-'-position on every field)
         where 'a' means 'access only', 'c' means 'create and delete only',
         'l' means 'list only', '---' means 'no access'.
         Order: '-<owner><group><other>'."""
-        # + see http://www.computerhope.com/unix/uchmod.htm
-        mode = mode[1:]
-        ugo = [0, 0, 0] # oct 0o000
-        corresponds = {'-': 0, 'a': 1, 'c': 2, 'l': 4}
-        for i, m in enumerate([mode[i: i + 3] for i in range(0, len(mode), 3)]):
-            for ch in m:
-                ugo[i] += corresponds[ch]
-        os.chmod(self._path, int("{}{}{}".format(*ugo), 8))
-
-    def chmod_inside(self, filemode=None, dirmode=None):
+        os.chmod(self._path, directory_mode(mode))
+        invalidate_stat(self._path)
+
+    def chmod_inside(self, filemode=None, dirmode=None, workers=None):
         """for example: filemode='-rwxr-x--x' -- Unix 'ls -l'-like syntax;
-        dirmode='-cal-al--l' (create and delete, access, list)."""
-        for item in self.get_items():
-            if filemode is not None and isinstance(item, File):
-                item.chmod(filemode)
-            if dirmode is not None and isinstance(item, Directory):
-                item.chmod(dirmode)
-                item.chmod_inside(filemode, dirmode)
-
-    def chown_inside(self, uid, gid):
+        dirmode='-cal-al--l' (create and delete, access, list); ints work too.
+        Whole tree, entries with right mode are skipped, symlinks are not touched;
+        top-level subdirectories are processed on 'workers' threads.
+        Return (<number of changed>, <number of skipped>)"""
+        filemode = None if filemode is None else file_mode(filemode)
+        dirmode = None if dirmode is None else directory_mode(dirmode)
+        def action(name, dir_fd, result):
+            if stat.S_ISLNK(result.st_mode):
+                return None
+            mode = dirmode if stat.S_ISDIR(result.st_mode) else filemode
+            if mode is None or stat.S_IMODE(result.st_mode) == mode:
+                return False
+            os.chmod(name, mode, dir_fd=dir_fd)
+            return True
+        return apply_inside(self._path, action, workers=workers)
+
+    def chown_inside(self, uid, gid, workers=None):
         """NOTE: (on the comp)
-        0 -- root, 1000 -- vanfed, 1001 -- sauron"""
-        for item in self.get_items():
-            item.chown(uid, gid)
-            if isinstance(item, Directory):
-                item.chown_inside(uid, gid)
-
-    def empty(self):
-        """remove all the items inside"""
-        self.delete()
-        self.create()
+        0 -- root, 1000 -- vanfed, 1001 -- sauron
+        (-1 keeps the id). Whole tree, symlinks themselves are changed (not their targets),
+        entries with right ids are skipped; see chmod_inside"""
+        def action(name, dir_fd, result):
+            if (uid == -1 or result.st_uid == uid) and (gid == -1 or result.st_gid == gid):
+                return False
+            os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+            return True
+        return apply_inside(self._path, action, workers=workers)
+
+    def empty(self, workers=None, progress=None):
+        """remove all the items inside (the directory itself with its
+        inode, owner and mode stays), see delete_tree()"""
+        delete_tree(self._path, workers=workers, keep_root=True, progress=progress)
 
     def remove(self, names, quiet=False):
         """remove all the items inside with given names"""
@@ -665,25 +1120,36 @@ class Directory(_Item):
             elif not quiet:
                 print("WARNING: '{}'' not in {}.".format(name, self))
 
-    def insert(self, paths, quiet=False):
-        """copy items with the paths link treat as directories"""
+    def insert(self, paths, quiet=False, workers=None):
+        """copy items with the paths link treat as directories;
+        conflicting names get '_<number>' suffix; the directory is listed once
+        and the items are copied on 'workers' threads (BulkError if some failed);
+        return BulkReport {<source item>: <copy>}"""
+        names = set(self.get_names())
+        new_names = {} # item -> name in the directory
         for path in paths:
-            item = Item(path)
+            item = Item(path, quiet=quiet)
             if item.exist():
-                if item.name in self.ls():
+                new_name = item.name
+                if new_name in names:
                     if not quiet:
                         print("WARNING: {} is in {}!".format(item, self))
                     index = 1
                     new_name = item.name + '_' + str(index)
-                    while new_name in self.ls():
+                    while new_name in names:
                         index += 1
                         new_name = item.name + '_' + str(index)
                     if not quiet:
                         print("WARNING: {} renamed to '{}' and pasted.".format(item, new_name))
-                item.copy_to(self, new_name)
+                names.add(new_name)
+                new_names[item] = new_name
             else:
                 if not quiet:
                     raise FileNotFoundError("Unidentified input item {}!".format(item)) # no in python2.7
+        self.report = bulk(lambda item: item.copy_to(self, new_names[item]), list(new_names),
+            workers=workers or WORKERS)
+        self.report.raise_errors()
+        return self.report
 
     def up(self):
         """return upper directory"""
@@ -696,7 +1162,9 @@ class Directory(_Item):
 
     def choose(self, number):
         """return the item inside with given number in 'ls'-list"""
-        return self.down(self.ls()[number])
+        if self.watching():
+            return self.down(self.ls()[number])
+        return self.down(self.listing()[number])
 
     def cd(self, quiet=False):
         """set the directory as current"""
@@ -704,7 +1172,40 @@ class Directory(_Item):
 
     def ls(self):
         """return list of names of the items inside"""
-        return sorted(os.listdir(self._path))
+        if self.watching():
+            return self._watch.ls()
+        return list(self.listing())
+
+    def listing(self):
+        """return cached sorted Listing of the names inside
+        (listed again only when the directory mtime changes)"""
+        if self._listing is None or not self._listing.valid():
+            self._listing = Listing(self._path)
+        return self._listing
+
+    def page(self, number, size=100):
+        """return names of the page of 'ls'-list (pages from 0)"""
+        return self.listing().page(number, size)
+
+    def watch(self, recursive=False, callback=None, poll_interval=1.0):
+        """start keeping the sorted listing in memory up to date (inotify on Linux,
+        mtime-pruned polling every 'poll_interval' seconds elsewhere);
+        while watching ls, len and 'in' do not touch the disk.
+        callback(<'created' or 'deleted'>, <path>) is called on every change.
+        Return DirectoryWatch (stop it with unwatch() or its stop())"""
+        self.unwatch()
+        self._watch = DirectoryWatch(self._path, recursive=recursive,
+            callback=callback, poll_interval=poll_interval)
+        return self._watch
+
+    def unwatch(self):
+        """stop watching the directory"""
+        if self._watch is not None:
+            self._watch.stop()
+            self._watch = None
+
+    def watching(self):
+        return self._watch is not None and self._watch.active
 
     @property
     def paths(self):
@@ -744,6 +1245,7 @@ class Group(set):
     def __init__(self, items, name='untitled'):
         set.__init__(self, items)
         self._name = name
+        self.report = None # BulkReport of the last bulk operation
 
     def __repr__(self):
         return "Group(..., name={})".format(self._name)
@@ -766,12 +1268,12 @@ class Group(set):
     def from_directory(directory=None, name='untitled'):
         if directory is None: directory = get_cd()
         if name == 'untitled': name = directory.name
-        return Group(directory.get_items(), name=name)
+        return Group(directory.scan(), name=name)
 
     @staticmethod
     def from_directory_path(directory_path='.', name='untitled'):
         if name == 'untitled': name = path2name(directory_path)
-        return Group(Directory(directory_path).get_items(), name=name)
+        return Group(scan(directory_path), name=name)
 
     def count(self, rule=None):
         if rule is None: rule = _true
@@ -800,8 +1302,25 @@ class Group(set):
     def filter(self, func):
         return filter(func, self)
 
-    def get_size(self):
-        return sum(map(lambda item: item.get_size, self))
+    def get_size(self, workers=None):
+        """return total size of the items (see report for the failed ones)"""
+        self.report = bulk(_item_get_size, self, workers=workers)
+        return sum(self.report.results.values())
+
+    def grep(self, patterns, workers=None, limit=None, binary=False, line_numbers=True, encoding='utf-8'):
+        """search the patterns in the files of the group on a process pool, see grep()"""
+        files = []
+        for item in self:
+            result = cached_stat(item.path)
+            if result is not None and stat.S_ISREG(result.st_mode):
+                files.append((item.path, result.st_size))
+        return grep(files, patterns, workers=workers, limit=limit, binary=binary,
+            line_numbers=line_numbers, encoding=encoding)
+
+    def duplicates(self, cache_path=None, link=False, workers=None, min_size=1, quiet=True):
+        """return list of Groups of duplicate files in the group, see find_duplicates()"""
+        return find_duplicates((item.path for item in self if isinstance(item, File)),
+            cache_path=cache_path, link=link, workers=workers, min_size=min_size, quiet=quiet)
 
     def get(self, name):
         """return items with the name"""
@@ -813,35 +1332,53 @@ class Group(set):
         return Group(self.get_paths(), name=new_name)
 
     def split(self, func):
-        """split this group with the function"""
-        results = map(func, self)
-        subgroups = [Group([item for item in self if func(item) == result],
-            name="splitted from {}".format(self._name)) for result in sorted(results)]
-        return subgroups
-
-    def strip(self, rule=None):
+        """split this group with the function (subgroups sorted by its values,
+        None first, e.g. directories for 'ext')"""
+        groups = self.group_by(func)
+        return [groups[key] for key in sorted(groups, key=lambda value: (value is not None, value))]
+
+    def group_by(self, key):
+        """return dict {<key value>: <subgroup>}, key is evaluated once per item;
+        key is a function of item or one of GROUP_KEYS names:
+        'ext', 'parent', 'size' (power of 2 upper bound), 'mtime_day' (datetime.date)"""
+        if isinstance(key, str):
+            key = GROUP_KEYS[key]
+        name = "splitted from {}".format(self._name)
+        groups = {}
+        for item in self:
+            value = key(item)
+            group = groups.get(value)
+            if group is None:
+                group = groups[value] = Group((), name=name)
+            group.add(item)
+        return groups
+
+    def strip(self, rule=None, workers=None):
         """remove the items if rule(<item>) return False,
         default: rule = lambda x: x.exist()"""
         if rule is None: rule = _item_exist
-        self -= self.cut(rule)
+        self.cut(rule, workers=workers)
 
-    def cut(self, rule):
-        """return new group of the items in the group if rule(<item>) return False"""
-        cutted = {item for item in self if not rule(item)}
+    def cut(self, rule, workers=None):
+        """return new group of the items in the group if rule(<item>) return False
+        (items where rule raised stay, see report)"""
+        self.report = bulk(rule, self, workers=workers)
+        cutted = {item for item, result in self.report.results.items() if not result}
         self -= cutted
         return Group(cutted, name="cutted from {}".format(self._name))
 
-    def apply(self, action, rule=None):
-        """apply func for every item in the group if rule(<item>) return True"""
+    def apply(self, action, rule=None, workers=None):
+        """apply func for every item in the group if rule(<item>) return True;
+        with 'workers' threads; return BulkReport (errors do not stop others)"""
         if rule is None: rule = _true
-        for item in filter(rule, self):
-            action(item)
+        self.report = bulk(action, self, rule=rule, workers=workers)
+        return self.report
 
-    def rename_all(self, func, rule=None):
-        """rename every item with func(name)"""
+    def rename_all(self, func, rule=None, workers=None):
+        """rename every item with func(name); return BulkReport"""
         if rule is None: rule = _true
-        for item in filter(rule, self):
-            item.rename(func(item.name))
+        self.report = bulk(lambda item: item.rename(func(item.name)), self, rule=rule, workers=workers)
+        return self.report
 
     @property
     def name(self):
@@ -874,6 +1411,78 @@ class Group(set):
     def items(self, items):
         self = Group(items, name=self._name)
 
+class BulkError(Exception):
+    """some items of a bulk operation failed, see .report"""
+
+    def __init__(self, report):
+        Exception.__init__(self, "{} of {} items failed".format(len(report.errors), report.total))
+        self.report = report
+
+class BulkReport(object):
+    """results and errors of a bulk operation:
+    'results' = {<item>: <result>}, 'errors' = {<item>: <exception>}"""
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+
+    def __repr__(self):
+        return "<BulkReport: {} done, {} failed>".format(len(self.results), len(self.errors))
+
+    def __bool__(self):
+        return not self.errors
+
+    def __nonzero__(self):
+        return not self.errors
+
+    @property
+    def total(self):
+        return len(self.results) + len(self.errors)
+
+    def raise_errors(self):
+        """raise BulkError if something failed"""
+        if self.errors:
+            raise BulkError(self)
+
+_skipped = object()
+
+def imap_unordered(func, iterable, workers=None):
+    """iterate over func(x) for x in iterable computed on 'workers' threads
+    (at most 2 * workers pending at once), in completion order;
+    workers <= 1 computes them here one by one"""
+    if workers is None or workers <= 1:
+        for x in iterable:
+            yield func(x)
+        return
+    iterator = iter(iterable)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = set(pool.submit(func, x) for x in itertools.islice(iterator, 2 * workers))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for x in itertools.islice(iterator, len(done)):
+                pending.add(pool.submit(func, x))
+            for future in done:
+                yield future.result()
+
+def bulk(action, items, rule=None, workers=None):
+    """apply action to every item (if rule(<item>)) on 'workers' threads
+    and return BulkReport; an exception in one item does not stop others"""
+    if rule is None: rule = _true
+    def call(item):
+        try:
+            if not rule(item):
+                return item, _skipped, None
+            return item, action(item), None
+        except Exception as error:
+            return item, None, error
+    report = BulkReport()
+    for item, result, error in imap_unordered(call, items, workers=workers):
+        if error is not None:
+            report.errors[item] = error
+        elif result is not _skipped:
+            report.results[item] = result
+    return report
+
 # a few useful functions
 
 def what_is(path, quiet=True):
@@ -923,8 +1532,162 @@ See path '{}'""".format(path))
             print("WARNING: path '{}' still does not exist".format(path))
         return File(path) if '.' in path.split(SEP)[-1] else Directory(path)
 
+# stat cache
+
+class StatCache(object):
+    """LRU cache of os.stat results keyed by (path, follow_symlinks);
+    an entry expires after 'ttl' seconds (None -- never) or when the
+    generation is bumped; the library's own move/rename/delete/copy/...
+    invalidate the paths they change"""
+
+    def __init__(self, ttl=1.0, maxsize=65536):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.generation = 0
+        self.epoch = 0 # bumped by every invalidation
+        self._entries = OrderedDict() # (path, follow_symlinks) -> (stat or None, time, generation)
+        self._keys = [] # sorted keys of _entries, for removing everything inside a directory
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "StatCache(ttl={}, maxsize={})".format(self.ttl, self.maxsize)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stat(self, path, follow_symlinks=True):
+        """return os.stat result or None if the path does not exist"""
+        key = (path, follow_symlinks)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, stamp, generation = entry
+                if generation == self.generation and (self.ttl is None or now - stamp < self.ttl):
+                    self._entries.move_to_end(key)
+                    return result
+            epoch = self.epoch
+        result = _stat(path, follow_symlinks)
+        self.put(path, result, follow_symlinks, now, epoch)
+        return result
+
+    def put(self, path, result, follow_symlinks=True, now=None, epoch=None):
+        """store known stat result (e.g. from os.DirEntry) for the path;
+        if 'epoch' (self.epoch when the result was taken) is given, the result
+        is dropped when something was invalidated since then (it may be stale)"""
+        key = (path, follow_symlinks)
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            if key not in self._entries:
+                bisect.insort(self._keys, key)
+            self._entries[key] = (result, time.monotonic() if now is None else now, self.generation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._remove_key(self._entries.popitem(last=False)[0])
+
+    def _remove_key(self, key):
+        del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def invalidate(self, path=None, recursive=False):
+        """forget the path (and everything inside if recursive) or everything if path is None"""
+        with self._lock:
+            self.epoch += 1
+            if path is None:
+                self._entries.clear()
+                del self._keys[:]
+                return
+            for key in ((path, False), (path, True)):
+                if self._entries.pop(key, None) is not None:
+                    self._remove_key(key)
+            if recursive:
+                # paths starting with prefix are in the range [prefix, prefix with the last char + 1)
+                prefix = path.rstrip(SEP) + SEP
+                start = bisect.bisect_left(self._keys, (prefix,))
+                stop = bisect.bisect_left(self._keys, (prefix[:-1] + chr(ord(SEP) + 1),))
+                for key in self._keys[start:stop]:
+                    del self._entries[key]
+                del self._keys[start:stop]
+
+    def new_generation(self):
+        """expire all the entries at once"""
+        with self._lock:
+            self.generation += 1
+            self.epoch += 1
+            self._entries.clear()
+            del self._keys[:]
+
+STAT_CACHE = None # disabled by default
+
+def _stat(path, follow_symlinks=True):
+    try:
+        return os.stat(path, follow_symlinks=follow_symlinks)
+    except (OSError, ValueError):
+        return None
+
+def enable_stat_cache(ttl=1.0, maxsize=65536):
+    """turn on per-process stat cache for _Item predicates and return it"""
+    global STAT_CACHE
+    STAT_CACHE = StatCache(ttl=ttl, maxsize=maxsize)
+    return STAT_CACHE
+
+def disable_stat_cache():
+    global STAT_CACHE
+    STAT_CACHE = None
+
+def cached_stat(path, follow_symlinks=True):
+    """return os.stat result of the path or None if it does not exist
+    (through the stat cache if it is enabled)"""
+    cache = STAT_CACHE
+    if cache is None:
+        return _stat(path, follow_symlinks)
+    return cache.stat(path, follow_symlinks)
+
+def invalidate_stat(path=None, recursive=False):
+    """forget cached stat of the path (see StatCache.invalidate)"""
+    cache = STAT_CACHE
+    if cache is not None:
+        cache.invalidate(path, recursive=recursive)
+
+def item_from_entry(entry):
+    """return File or Directory for os.DirEntry, like Item but using
+    the type cached by os.scandir instead of stat'ing the path again"""
+    try:
+        if entry.is_dir():
+            return Directory.from_entry(entry)
+        if entry.is_file():
+            return File.from_entry(entry)
+    except OSError:
+        pass
+    # broken symlink or special file: guess like Item does
+    return File.from_entry(entry) if '.' in entry.name else Directory.from_entry(entry)
+
+def scan(directory_path='.'):
+    """iterate over the items inside the directory with the path (os.scandir)"""
+    with os.scandir(abspath(directory_path)) as entries:
+        for entry in entries:
+            yield item_from_entry(entry)
+
 HOME_DIRECTORY = Directory('~')
 
+def walk_entries(directory_path='.'):
+    """iterate over os.DirEntry of every item inside the directory tree
+    (iteratively, symlinks to directories are not followed)"""
+    stack = [abspath(directory_path)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                yield entry
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                except OSError:
+                    pass
+
 def glob(path_pattern):
     """search for files here with RegExp (glob)"""
     return glob.glob(path_pattern)
@@ -1042,16 +1805,18 @@ def up(height=1, quiet=False):
 def mkdir(directory_path):
     """create directory with the path"""
     os.mkdir(abspath(directory_path))
+    invalidate_stat(abspath(directory_path))
 
 def rmdir(directory_path):
     """remove just EMPTY directory with the path"""
     os.rmdir(abspath(directory_path))
+    invalidate_stat(abspath(directory_path))
 
 def lsdir(directory_path, postfunction=None):
     """list content of the directory with the path,
     postfunction by default is lambda x: x.name"""
     if postfunction is None: postfunction = _item_name
-    return [postfunction(item) for item in Directory(directory_path)]
+    return [postfunction(item) for item in scan(directory_path)]
 
 def ls(postfunction=None):
     """list content of the current directory,
@@ -1064,10 +1829,2612 @@ def unlock_pycache(path=None):
     if path is None: path = (parent(__file__)/"__pycache__"/"filesystem.cpython-35.pyc").path
     File(path).chown(1000, 1000)
 
+# cached listings
+
+class Listing(object):
+    """Sorted snapshot of the names inside a directory kept compactly
+    (one string + array of offsets): O(1) len, indexing and pages,
+    O(log n) 'in'; valid() while the directory mtime is the same"""
+
+    def __init__(self, directory_path):
+        self._path = abspath(directory_path)
+        self.refresh()
+
+    def __repr__(self):
+        return "Listing('{}', {} names)".format(self._path, len(self))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Listing index out of range")
+        return self._names[self._offsets[index]:self._offsets[index + 1] - 1]
+
+    def __iter__(self):
+        return iter(self._names.split('\0')) if len(self) else iter(())
+
+    def __contains__(self, name):
+        i = bisect.bisect_left(self, name) # works through __getitem__/__len__
+        return i < len(self) and self[i] == name
+
+    def refresh(self):
+        """list the directory again"""
+        self._mtime = os.stat(self._path).st_mtime_ns
+        names = sorted(os.listdir(self._path))
+        self._names = '\0'.join(names)
+        self._offsets = array('Q', [0])
+        self._offsets.extend(itertools.accumulate(len(name) + 1 for name in names))
+
+    def valid(self):
+        """check if the directory mtime did not change since the snapshot"""
+        result = _stat(self._path)
+        return result is not None and result.st_mtime_ns == self._mtime
+
+    def page(self, number, size=100):
+        """return names of the page (pages from 0)"""
+        return self[number * size:(number + 1) * size]
+
+# live directory watch (inotify)
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = getattr(os, 'O_NONBLOCK', 0)
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+_IN_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_IN_EVENT = struct.Struct('iIII') # wd, mask, cookie, len (+ name)
+
+def _load_inotify():
+    """return libc with inotify functions or None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+_libc_inotify = None
+
+class DirectoryWatch(object):
+    """In-memory sorted listing of a directory (and its subdirectories if recursive)
+    kept up to date by inotify events (or by polling if inotify is unavailable);
+    when the event queue overflows the listing is rebuilt with rescan(),
+    which relists only the directories whose mtime changed"""
+
+    def __init__(self, path, recursive=False, callback=None, poll_interval=1.0):
+        global _libc_inotify
+        self._path = abspath(path)
+        self._recursive = recursive
+        self._callbacks = [] if callback is None else [callback]
+        self._poll_interval = poll_interval
+        self._lock = threading.RLock()
+        self._listings = {} # directory path -> (sorted list of names, set of names)
+        self._mtimes = {} # directory path -> st_mtime_ns at the moment of listing
+        self._wds = {} # watch descriptor -> directory path
+        self._dirs = {} # directory path -> watch descriptor
+        self._alive = True # False when the watched directory itself is gone
+        self._stopped = False
+        if _libc_inotify is None:
+            _libc_inotify = _load_inotify() or False
+        self._libc = _libc_inotify or None
+        self._fd = None
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+            else:
+                self._libc = None
+        self._wake = threading.Event() # wakes the polling loop on stop()
+        self._wake_r = self._wake_w = None # wakes the inotify loop on stop()
+        if self._fd is not None:
+            self._wake_r, self._wake_w = os.pipe()
+        with self._lock:
+            self._add_directory(self._path, notify=False)
+        self._thread = threading.Thread(target=self._run, name="watch {}".format(self._path))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return "DirectoryWatch('{}', recursive={})".format(self._path, self._recursive)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._listings.get(self._path, ((), ()))[1])
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._listings.get(self._path, ((), ()))[1]
+
+    def __iter__(self):
+        return iter(self.ls())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def active(self):
+        return self._alive and not self._stopped
+
+    @property
+    def inotify(self):
+        """True if driven by inotify events, False if by polling"""
+        return self._fd is not None
+
+    def ls(self, path=None):
+        """return sorted names inside the watched directory
+        (or inside a watched subdirectory with the path)"""
+        path = self._path if path is None else abspath(path)
+        with self._lock:
+            return list(self._listings.get(path, ((), ()))[0])
+
+    def contains(self, path):
+        """check if the path is inside the watched tree"""
+        path = abspath(path)
+        directory_path, name = op.split(path)
+        with self._lock:
+            return name in self._listings.get(directory_path, ((), ()))[1]
+
+    def tree(self):
+        """return dict {<directory path>: <sorted names>} of all watched directories"""
+        with self._lock:
+            return {path: list(listing[0]) for path, listing in self._listings.items()}
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def stop(self):
+        """stop watching and release the inotify descriptor"""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wake.set()
+        if self._wake_w is not None:
+            os.write(self._wake_w, b'x')
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        for fd in (self._fd, self._wake_r, self._wake_w):
+            if fd is not None:
+                os.close(fd)
+        self._fd = None
+
+    def rescan(self):
+        """relist every watched directory whose mtime changed"""
+        with self._lock:
+            for path in list(self._listings):
+                if path not in self._listings: # removed with its parent
+                    continue
+                result = _stat(path, follow_symlinks=False)
+                if result is None or not stat.S_ISDIR(result.st_mode):
+                    if path == self._path:
+                        self._alive = False
+                    self._remove_directory(path)
+                    continue
+                if result.st_mtime_ns == self._mtimes.get(path):
+                    continue
+                names, dirnames, mtime = self._list(path)
+                old = self._listings[path][1]
+                for name in sorted(old - names):
+                    self._deleted(path, name)
+                for name in sorted(names - old):
+                    self._created(path, name, name in dirnames)
+                self._mtimes[path] = mtime
+
+    def _notify(self, kind, path):
+        invalidate_stat(path, recursive=True)
+        for callback in list(self._callbacks):
+            try:
+                callback(kind, path)
+            except Exception as error:
+                print("WARNING: watch callback {!r} failed on {} {}: {!r}".format(callback, kind, path, error))
+
+    def _list(self, path):
+        """return (set of names, set of subdirectory names, mtime before listing)"""
+        mtime = os.stat(path).st_mtime_ns
+        names = set()
+        dirnames = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                names.add(entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirnames.add(entry.name)
+                except OSError:
+                    pass
+        return names, dirnames, mtime
+
+    def _add_directory(self, path, notify=True):
+        """start watching the directory (and subdirectories if recursive)"""
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            if path in self._listings:
+                continue
+            if self._fd is not None:
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _IN_MASK)
+                if wd < 0:
+                    if path == self._path:
+                        error = ctypes.get_errno()
+                        raise OSError(error, os.strerror(error), path)
+                    continue # vanished or not accessible
+                self._wds[wd] = path
+                self._dirs[path] = wd
+            try:
+                names, dirnames, mtime = self._list(path)
+            except OSError:
+                if path == self._path:
+                    raise
+                continue
+            self._listings[path] = (sorted(names), names)
+            self._mtimes[path] = mtime
+            for name in self._listings[path][0]:
+                if notify:
+                    self._notify('created', concat(path, name))
+                if self._recursive and name in dirnames:
+                    stack.append(concat(path, name))
+
+    def _remove_directory(self, path):
+        """stop watching the directory and everything inside"""
+        prefix = path + SEP
+        for directory_path in [p for p in self._listings if p == path or p.startswith(prefix)]:
+            del self._listings[directory_path]
+            self._mtimes.pop(directory_path, None)
+            wd = self._dirs.pop(directory_path, None)
+            if wd is not None:
+                self._wds.pop(wd, None)
+                if self._fd is not None:
+                    self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _created(self, directory_path, name, is_dir):
+        listing = self._listings.get(directory_path)
+        if listing is None or name in listing[1]:
+            return
+        bisect.insort(listing[0], name)
+        listing[1].add(name)
+        path = concat(directory_path, name)
+        self._notify('created', path)
+        if self._recursive and is_dir:
+            self._add_directory(path)
+
+    def _deleted(self, directory_path, name):
+        listing = self._listings.get(directory_path)
+        if listing is None or name not in listing[1]:
+            return
+        del listing[0][bisect.bisect_left(listing[0], name)]
+        listing[1].discard(name)
+        path = concat(directory_path, name)
+        if path in self._listings:
+            self._remove_directory(path)
+        self._notify('deleted', path)
+
+    def _run(self):
+        try:
+            if self._fd is None: # polling (no inotify, e.g. not Linux)
+                while not self._wake.wait(self._poll_interval):
+                    self.rescan()
+                return
+            poller = select.poll()
+            poller.register(self._wake_r, select.POLLIN)
+            poller.register(self._fd, select.POLLIN)
+            while not self._stopped:
+                ready = poller.poll()
+                if self._stopped:
+                    break
+                if ready:
+                    self._read_events()
+        finally:
+            if not self._stopped: # died: the listing is not kept up to date anymore
+                self._alive = False
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        overflow = False
+        with self._lock:
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _IN_EVENT.unpack_from(data, offset)
+                offset += _IN_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                directory_path = self._wds.get(wd)
+                if directory_path is None:
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._created(directory_path, name, bool(mask & IN_ISDIR))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._deleted(directory_path, name)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    if directory_path == self._path:
+                        self._listings[self._path] = ([], set())
+                        self._alive = False
+                    elif mask & IN_IGNORED:
+                        self._wds.pop(wd, None)
+                        self._dirs.pop(directory_path, None)
+            if overflow:
+                self.rescan()
+
+# multi-pattern search
+
+class AhoCorasick(object):
+    """Aho-Corasick automaton over non-empty bytes literals"""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._lengths = [len(pattern) for pattern in self.patterns]
+        if not all(self._lengths):
+            raise ValueError("AhoCorasick does not support empty patterns")
+        goto = [{}]
+        fail = [0]
+        out = [[]]
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for byte in pattern:
+                next_state = goto[state].get(byte)
+                if next_state is None:
+                    goto.append({})
+                    fail.append(0)
+                    out.append([])
+                    next_state = goto[state][byte] = len(goto) - 1
+                state = next_state
+            out[state].append(i)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for byte, next_state in goto[state].items():
+                queue.append(next_state)
+                f = fail[state]
+                while f and byte not in goto[f]:
+                    f = fail[f]
+                fail[next_state] = goto[f].get(byte, 0)
+                out[next_state] = out[next_state] + out[fail[next_state]]
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        # from the root state only these bytes lead somewhere, skip the rest at C speed
+        self._first = None
+        if goto[0]:
+            self._first = re.compile(b'[' + b''.join(re.escape(bytes([byte])) for byte in goto[0]) + b']')
+
+    def __repr__(self):
+        return "AhoCorasick({} patterns)".format(len(self.patterns))
+
+    def finditer(self, buffer, chunk_size=CHUNK_SIZE):
+        """iterate over (<start offset>, <pattern index>) in bytes-like 'buffer'
+        (e.g. mmap) reading it by chunks"""
+        goto, fail, out, lengths = self._goto, self._fail, self._out, self._lengths
+        first = self._first
+        if not goto[0]:
+            return
+        state = 0
+        position = 0
+        size = len(buffer)
+        while position < size:
+            chunk = buffer[position:position + chunk_size]
+            i = 0
+            n = len(chunk)
+            while i < n:
+                if state == 0:
+                    match = first.search(chunk, i)
+                    if match is None:
+                        break
+                    i = match.start()
+                byte = chunk[i]
+                while state and byte not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(byte, 0)
+                for k in out[state]:
+                    yield position + i - lengths[k] + 1, k
+                i += 1
+            position += n
+
+def _count_newlines(buffer, start, end, chunk_size=CHUNK_SIZE):
+    number = 0
+    for position in range(start, end, chunk_size):
+        number += buffer[position:min(position + chunk_size, end)].count(b'\n')
+    return number
+
+def search(path, patterns, line_numbers=False, encoding='utf-8'):
+    """iterate lazily over (<byte offset>, <pattern>) of every occurrence of the patterns
+    in the file with the path, see File.search; empty literals are ignored"""
+    if isinstance(patterns, (str, bytes)):
+        patterns = [patterns]
+    if not hasattr(patterns, 'finditer'):
+        patterns = [pattern for pattern in patterns if pattern]
+        if not patterns:
+            return
+    elif isinstance(patterns.pattern, str):
+        flags = patterns.flags & ~re.UNICODE
+        patterns = re.compile(patterns.pattern.encode(encoding), flags)
+    with open(abspath(path), 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if hasattr(patterns, 'finditer'):
+                hits = ((match.start(), match.group()) for match in patterns.finditer(buffer))
+            else:
+                automaton = AhoCorasick(pattern.encode(encoding) if isinstance(pattern, str)
+                    else pattern for pattern in patterns)
+                hits = ((offset, patterns[k]) for offset, k in automaton.finditer(buffer))
+            try:
+                if not line_numbers:
+                    for hit in hits:
+                        yield hit
+                    return
+                line, position = 1, 0
+                for offset, pattern in hits:
+                    if offset >= position:
+                        line += _count_newlines(buffer, position, offset)
+                    else:
+                        line -= _count_newlines(buffer, offset, position)
+                    position = offset
+                    yield offset, line, pattern
+            finally:
+                hits.close() # release the mmap before closing it
+                del hits
+
+# streaming rewrite
+
+def _literals_regex(literals):
+    """alternation of the literals, earlier rules first"""
+    return re.compile('|'.join(map(re.escape, sorted(literals, key=lambda literal: literals[literal][0]))))
+
+def rewrite(path, rules, encoding=None, window=1 << 12, quiet=True):
+    """replace by the rules in one pass over the text file with the path;
+    'rules' = iterator of (<old>, <new> [, <max number of replacings>]),
+    <old> is a string or a compiled regular expression (then <new> is
+    a template like in re.sub or a function of the match);
+    at every position the earliest listed matching rule wins;
+    matches (and regex look-ahead and look-behind) must be shorter than
+    'window' chars; 'window' chars of the already written text are kept
+    before the searched part, so ^, \\b and look-behinds see real context.
+    The result is written to a temporary file and renamed over the file.
+    Return list of numbers of replacings for every rule"""
+    path = abspath(path)
+    rules = [tuple(rule) for rule in rules]
+    hits = [0] * len(rules)
+    limits = [rule[2] if len(rule) > 2 else None for rule in rules]
+    literals = {} # literal -> indexes of active rules with it
+    searchers = {} # None (all literals) or rule index -> compiled regular expression
+    for i, rule in enumerate(rules):
+        if limits[i] is not None and limits[i] <= 0:
+            continue
+        if hasattr(rule[0], 'search'):
+            searchers[i] = rule[0]
+        elif rule[0]:
+            literals.setdefault(rule[0], []).append(i)
+    if literals:
+        searchers[None] = _literals_regex(literals)
+    directory_path, name = op.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + name + '.', dir=directory_path)
+    try:
+        with open(path, 'r', encoding=encoding, newline='') as source, \
+                open(fd, 'w', encoding=encoding, newline='') as target:
+            chunk_size = max(CHUNK_SIZE, 4 * window)
+            buffer = ''
+            position = 0 # buffer[:position] is already written context
+            eof = ended = False
+            while not eof:
+                chunk = source.read(chunk_size)
+                eof = not chunk
+                buffer += chunk
+                limit = len(buffer) if eof else max(position, len(buffer) - window)
+                cache = {} # searcher -> next match (None -- no more in the buffer)
+                while True:
+                    best = None # (match, rule index, searcher)
+                    for key, regex in searchers.items():
+                        match = cache.get(key, False)
+                        if match is False or (match is not None and match.start() < position):
+                            match = cache[key] = regex.search(buffer, position)
+                        if match is None:
+                            continue
+                        i = key if key is not None else literals[match.group()][0]
+                        if best is None or (match.start(), i) < (best[0].start(), best[1]):
+                            best = (match, i, key)
+                    final = eof and not ended and best is not None \
+                        and best[0].start() == best[0].end() == len(buffer) # empty match at the end of the text
+                    if best is None or (best[0].start() >= limit and not final) or (best[0].end() > limit and not eof):
+                        stop = limit if best is None else min(best[0].start(), limit)
+                        stop = max(stop, position)
+                        target.write(buffer[position:stop])
+                        keep = max(0, stop - window)
+                        buffer = buffer[keep:]
+                        position = stop - keep
+                        break
+                    match, i, key = best
+                    start, end = match.span()
+                    target.write(buffer[position:start])
+                    new = rules[i][1]
+                    if key is None:
+                        target.write(new)
+                    else:
+                        target.write(new(match) if callable(new) else match.expand(new))
+                    hits[i] += 1
+                    position = end
+                    if start == end and end < len(buffer): # empty match: step over one char
+                        target.write(buffer[end])
+                        position += 1
+                    elif final:
+                        ended = True
+                    if limits[i] is not None and hits[i] >= limits[i]:
+                        cache.pop(key, None)
+                        if key is None:
+                            indexes = literals[rules[i][0]]
+                            indexes.remove(i)
+                            if indexes:
+                                searchers[None] = _literals_regex(literals)
+                            else:
+                                del literals[rules[i][0]]
+                                if literals:
+                                    searchers[None] = _literals_regex(literals)
+                                else:
+                                    del searchers[None]
+                        else:
+                            del searchers[i]
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except:
+        if op.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    invalidate_stat(path)
+    if not quiet:
+        for rule, number in zip(rules, hits):
+            print("Replaced {0!r} with {1!r} {2} times.".format(rule[0], rule[1], number))
+    return hits
+
+# atomic writes
+
+def fsync_directory(directory_path):
+    """flush directory entries (e.g. a rename inside) to disk"""
+    fd = os.open(directory_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _temp_sibling(path):
+    """create new hidden file next to path, return (fd opened for writing, its path)"""
+    directory_path, name = op.split(path)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_CLOEXEC', 0)
+    while True:
+        temp_path = concat(directory_path, '.{}.{}'.format(name, os.urandom(4).hex()))
+        try:
+            return os.open(temp_path, flags, 0o666), temp_path # the kernel applies the umask
+        except FileExistsError:
+            continue
+
+def _write_temp(path, data, encoding=None, fsync=True):
+    """write data (str or bytes) to a temporary sibling of path with the
+    mode of path (or default one for a new file), return its path"""
+    fd, temp_path = _temp_sibling(path)
+    try:
+        with (open(fd, 'wb') if isinstance(data, bytes) else open(fd, 'w', encoding=encoding)) as file:
+            file.write(data)
+            file.flush()
+            if fsync:
+                os.fsync(file.fileno())
+        if op.exists(path):
+            shutil.copymode(path, temp_path)
+    except:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+def write_atomic(path, data, encoding=None, fsync=True):
+    """replace content of the file with data (str or bytes) atomically:
+    write a temporary sibling, fsync it, rename it over the file and
+    fsync the directory (without fsync only atomicity is guaranteed);
+    a symlink is resolved, so its target file is replaced (not the link)"""
+    link_path, path = abspath(path), op.realpath(path)
+    temp_path = _write_temp(path, data, encoding, fsync)
+    try:
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    invalidate_stat(path)
+    invalidate_stat(link_path)
+    if fsync:
+        fsync_directory(op.dirname(path))
+
+class AtomicBatch(object):
+    """Group commit of atomic writes: files are written to temporary siblings
+    and fsync'ed concurrently, then renamed, then every parent directory is
+    fsync'ed once; used as context manager it commits on success:
+        with AtomicBatch() as batch:
+            for file, text in states:
+                batch.set_text(file, text)
+    """
+
+    def __init__(self, encoding=None, fsync=True, workers=None):
+        self.encoding = encoding
+        self.fsync = fsync
+        self.workers = workers or WORKERS
+        self.report = None
+        self._pending = OrderedDict() # real path -> (data, encoding)
+        self._links = set() # queued paths with symlinks (their stat is invalidated on commit)
+
+    def __repr__(self):
+        return "<AtomicBatch: {} pending>".format(len(self._pending))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def set_text(self, file, new_text, encoding=None):
+        """queue new text of the File (or path), later writes win"""
+        link_path = abspath(file.path if isinstance(file, _Item) else file)
+        path = op.realpath(link_path) # write the target of a symlink
+        if path != link_path:
+            self._links.add(link_path)
+        self._pending.pop(path, None)
+        self._pending[path] = (new_text, encoding or self.encoding)
+
+    def set_bytes(self, file, data):
+        self.set_text(file, bytes(data))
+
+    def discard(self):
+        self._pending.clear()
+        self._links.clear()
+
+    def commit(self):
+        """write everything queued, return BulkReport {<path>: <size>}
+        (raise BulkError if some files failed, the others are committed)"""
+        pending, self._pending = self._pending, OrderedDict()
+        links, self._links = self._links, set()
+        staged = bulk(lambda path: _write_temp(path, *pending[path], fsync=self.fsync), pending, workers=self.workers)
+        self.report = report = BulkReport()
+        report.errors.update(staged.errors)
+        directories = set()
+        for path in pending:
+            if path not in staged.results:
+                continue
+            try:
+                os.replace(staged.results[path], path)
+            except OSError as error:
+                os.remove(staged.results[path])
+                report.errors[path] = error
+                continue
+            invalidate_stat(path)
+            report.results[path] = len(pending[path][0])
+            directories.add(op.dirname(path))
+        if self.fsync:
+            synced = bulk(fsync_directory, directories, workers=self.workers)
+            for directory_path, error in synced.errors.items():
+                for path in list(report.results):
+                    if op.dirname(path) == directory_path:
+                        report.errors[path] = error
+                        del report.results[path]
+        for path in links:
+            invalidate_stat(path)
+        report.raise_errors()
+        return report
+
+def write_many(texts, encoding=None, fsync=True, workers=None):
+    """atomically write {<File or path>: <text or bytes>} with one fsync
+    per parent directory, see AtomicBatch"""
+    batch = AtomicBatch(encoding, fsync, workers)
+    for file, text in texts.items():
+        batch.set_text(file, text)
+    return batch.commit()
+
+# parallel grep
+
+def is_binary(path, sniff_size=8192):
+    """guess if the file is binary: NUL byte in its first 'sniff_size' bytes"""
+    with open(path, 'rb') as file:
+        return b'\0' in file.read(sniff_size)
+
+def balanced_batches(sized, number):
+    """split (<path>, <size>) pairs into 'number' lists with close total sizes
+    (the largest first into the lightest list)"""
+    batches = [[] for _ in range(number)]
+    heap = [(0, i) for i in range(number)]
+    for path, size in sorted(sized, key=lambda pair: pair[1], reverse=True):
+        total, i = heapq.heappop(heap)
+        batches[i].append(path)
+        heapq.heappush(heap, (total + size, i))
+    return [batch for batch in batches if batch]
+
+def _grep_file(path, patterns, line_numbers, binary, encoding):
+    """iterate over hits of search() in the file prefixed with the path"""
+    try:
+        if not binary and is_binary(path):
+            return
+        hits = search(path, patterns, line_numbers=line_numbers, encoding=encoding)
+    except OSError:
+        return # vanished or not readable
+    try:
+        for hit in hits:
+            yield (path,) + hit
+    except OSError:
+        pass
+    finally:
+        hits.close()
+
+_grep_queue = _grep_stop = None # in grep worker processes, see _grep_init
+
+def _grep_init(hits_queue, stop):
+    global _grep_queue, _grep_stop
+    _grep_queue, _grep_stop = hits_queue, stop
+
+def _grep_batch(paths, patterns, line_numbers, binary, encoding, limit, chunk_size=256):
+    """send hits to _grep_queue by chunks (at least one per file with hits),
+    then None; stop between chunks when _grep_stop is set"""
+    found = 0
+    try:
+        for path in paths:
+            if _grep_stop.is_set():
+                return
+            chunk = []
+            for hit in _grep_file(path, patterns, line_numbers, binary, encoding):
+                chunk.append(hit)
+                found += 1
+                if limit is not None and found >= limit:
+                    _grep_queue.put(chunk)
+                    return
+                if len(chunk) >= chunk_size:
+                    _grep_queue.put(chunk)
+                    chunk = []
+                    if _grep_stop.is_set():
+                        return
+            if chunk:
+                _grep_queue.put(chunk)
+    finally:
+        _grep_queue.put(None)
+
+def grep(files, patterns, workers=None, limit=None, binary=False, line_numbers=True, encoding='utf-8'):
+    """search the patterns (see search()) in the files on a pool of 'workers' processes
+    and iterate over (<path>, <byte offset>, [<line number>,] <pattern>) as they are found
+    (sent from workers after every file or every 256 hits);
+    'files' = iterable of paths or (<path>, <size>) pairs (to balance batches by size);
+    binary files (NUL byte in the beginning) are skipped unless binary=True;
+    stop after 'limit' hits (workers stop searching too)"""
+    sized = [(file, op.getsize(file)) if isinstance(file, str) else tuple(file) for file in files]
+    if not sized or (limit is not None and limit <= 0):
+        return
+    workers = workers or os.cpu_count() or 1
+    found = 0
+    if workers == 1:
+        for path, _ in sized:
+            for hit in _grep_file(path, patterns, line_numbers, binary, encoding):
+                yield hit
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+        return
+    batches = balanced_batches(sized, min(len(sized), workers * 4))
+    context = multiprocessing.get_context()
+    hits_queue, stop = context.Queue(), context.Event()
+    pool = ProcessPoolExecutor(workers, mp_context=context, initializer=_grep_init, initargs=(hits_queue, stop))
+    futures = []
+    finished = [0] # batches which sent their None
+    def receive():
+        """next chunk of hits (None -- a batch finished), raise error of a failed worker"""
+        while True:
+            try:
+                chunk = hits_queue.get(timeout=0.1)
+            except queue.Empty:
+                for future in futures:
+                    if future.done() and not future.cancelled() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            if chunk is None:
+                finished[0] += 1
+            return chunk
+    try:
+        futures.extend(pool.submit(_grep_batch, batch, patterns, line_numbers, binary, encoding, limit)
+                       for batch in batches)
+        while finished[0] < len(futures):
+            for hit in receive() or ():
+                yield hit
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+        for future in futures:
+            future.result()
+    finally:
+        stop.set()
+        started = sum(not future.cancel() for future in futures)
+        try:
+            while finished[0] < started:
+                receive() # drain, so that workers are not blocked on the full queue
+        except Exception:
+            pass # broken pool
+        pool.shutdown(wait=True, cancel_futures=True)
+        hits_queue.close()
+        hits_queue.cancel_join_thread()
+
+# copy engine
+
+_COPY_FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.ENOTSUP, errno.EBADF, errno.ETXTBSY, errno.EPERM}
+
+def _copy_data(source_fd, target_fd):
+    """copy the rest of the source to the target (both from current positions):
+    os.copy_file_range (in kernel, reflinks and server side copies),
+    then os.sendfile, then plain read/write; return number of bytes"""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                n = os.copy_file_range(source_fd, target_fd, 1 << 30)
+                if n == 0:
+                    return copied
+                copied += n
+        except OSError as error:
+            if error.errno not in _COPY_FALLBACK_ERRORS:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while True:
+                n = os.sendfile(target_fd, source_fd, None, 1 << 30)
+                if n == 0:
+                    return copied
+                copied += n
+        except OSError as error:
+            if error.errno not in _COPY_FALLBACK_ERRORS:
+                raise
+    while True:
+        data = os.read(source_fd, CHUNK_SIZE)
+        if not data:
+            return copied
+        copied += os.write(target_fd, data)
+
+def _special_file_error(path, mode):
+    """shutil.SpecialFileError for a FIFO, socket or device node"""
+    for check, kind in ((stat.S_ISFIFO, 'a named pipe'), (stat.S_ISSOCK, 'a socket'),
+                        (stat.S_ISCHR, 'a character device'), (stat.S_ISBLK, 'a block device')):
+        if check(mode):
+            break
+    else:
+        kind = 'not a regular file'
+    return shutil.SpecialFileError("`{}` is {}".format(path, kind))
+
+def copy_file(source_path, target_path):
+    """copy data of the file (without metadata) in kernel when possible;
+    return number of bytes; raise shutil.SpecialFileError for FIFOs, sockets
+    and devices (instead of blocking on them)"""
+    mode = os.stat(source_path).st_mode
+    if not stat.S_ISREG(mode):
+        raise _special_file_error(source_path, mode)
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        return _copy_data(source.fileno(), target.fileno())
+
+class CopyReport(BulkReport):
+    """BulkReport of copy_tree: 'results' = {<source path>: <bytes>}, 'errors' = {<source path>: <exception>}"""
+
+    def __init__(self):
+        BulkReport.__init__(self)
+        self.directories = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "<CopyReport: {} files, {} directories, {} bytes in {:.2f}s ({:.1f} MB/s), {} failed>".format(
+            len(self.results), self.directories, self.bytes, self.seconds, self.throughput / 1e6, len(self.errors))
+
+    @property
+    def throughput(self):
+        """bytes per second"""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+def _copy_tree_file(pair):
+    source_path, target_path = pair
+    try:
+        size = copy_file(source_path, target_path)
+        shutil.copystat(source_path, target_path)
+        return source_path, size, None
+    except Exception as error:
+        return source_path, None, error
+
+def copy_tree(source_path, target_path, workers=None, symlinks=False, quiet=True):
+    """copy the directory tree a-la shutil.copytree: directories are created
+    while walking ahead of 'workers' threads copying files (copy_file + copystat);
+    symlinks are recreated if symlinks=True, otherwise their targets are copied
+    (dangling ones are recreated); FIFOs, sockets and devices are not opened
+    but reported as errors (shutil.SpecialFileError); return CopyReport with throughput"""
+    start = time.monotonic()
+    source_path, target_path = abspath(source_path), abspath(target_path)
+    report = CopyReport()
+    directories = [] # (source, target) to copy metadata after the files
+    def walk():
+        stack = [(source_path, target_path)]
+        os.mkdir(target_path)
+        while stack:
+            source_directory, target_directory = stack.pop()
+            directories.append((source_directory, target_directory))
+            try:
+                entries = list(os.scandir(source_directory))
+            except OSError as error:
+                report.errors[source_directory] = error
+                continue
+            for entry in entries:
+                target = concat(target_directory, entry.name)
+                try:
+                    if entry.is_symlink() and (symlinks or not op.exists(entry.path)):
+                        os.symlink(os.readlink(entry.path), target)
+                        shutil.copystat(entry.path, target, follow_symlinks=False)
+                    elif entry.is_dir():
+                        os.mkdir(target)
+                        stack.append((entry.path, target))
+                    elif entry.is_file():
+                        yield entry.path, target
+                    else:
+                        report.errors[entry.path] = _special_file_error(entry.path, entry.stat().st_mode)
+                except OSError as error:
+                    report.errors[entry.path] = error
+    for path, size, error in imap_unordered(_copy_tree_file, walk(), workers=workers or WORKERS):
+        if error is None:
+            report.results[path] = size
+            report.bytes += size
+        else:
+            report.errors[path] = error
+            if not quiet:
+                print("WARNING: {} not copied: {}".format(path, error))
+    for source_directory, target_directory in reversed(directories):
+        try:
+            shutil.copystat(source_directory, target_directory)
+        except OSError as error:
+            report.errors[source_directory] = error
+    report.directories = len(directories)
+    report.seconds = time.monotonic() - start
+    invalidate_stat(target_path, recursive=True)
+    if not quiet:
+        print(report)
+    return report
+
+# mirror engine
+
+def file_hash(path, algorithm='sha256', chunk_size=CHUNK_SIZE):
+    """return hex digest of the content of the file with the path"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as file:
+        chunk = file.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = file.read(chunk_size)
+    return digest.hexdigest()
+
+def remove_path(path):
+    """remove file, link or directory tree with the path"""
+    if op.isdir(path) and not op.islink(path):
+        delete_tree(path)
+    else:
+        os.remove(path)
+    invalidate_stat(path, recursive=True)
+
+class SyncPlan(object):
+    """what sync_tree does (or did):
+    'trees' -- (source, target) directories missing in the target, copied whole;
+    'files' -- (source, target) new or changed files;
+    'links' -- (source, target) new or changed symlinks;
+    'replace' -- target paths of other type than in the source (removed first);
+    'extraneous' -- target paths absent in the source (removed if delete=True);
+    'pruned' -- source directories whose files were not compared (see manifest);
+    'special' -- source FIFOs, sockets and devices (not copied, reported as errors);
+    'report' -- CopyReport after execution (None for dry run)"""
+
+    def __init__(self, source_path, target_path):
+        self.source_path = source_path
+        self.target_path = target_path
+        self.trees = []
+        self.files = []
+        self.links = []
+        self.replace = []
+        self.extraneous = []
+        self.pruned = []
+        self.special = []
+        self.report = None
+
+    def __repr__(self):
+        return "<SyncPlan '{}' -> '{}': {} trees, {} files, {} links, {} replaced, {} extraneous, {} pruned>".format(
+            self.source_path, self.target_path, len(self.trees), len(self.files),
+            len(self.links), len(self.replace), len(self.extraneous), len(self.pruned))
+
+    def __bool__(self):
+        """True if there is something to do"""
+        return bool(self.trees or self.files or self.links or self.replace or self.extraneous)
+
+    def __nonzero__(self):
+        return self.__bool__()
+
+def _entry_kind(entry):
+    if entry.is_symlink():
+        return 'link'
+    if entry.is_dir():
+        return 'directory'
+    if entry.is_file():
+        return 'file'
+    return 'special'
+
+def _replace_file(pair):
+    """copy the source file (with metadata) to a temporary sibling of the target
+    and rename it over the target (works for read-only targets, does not write
+    through hard links of the target, never leaves it half-written)"""
+    source_path, target_path = pair
+    try:
+        mode = os.stat(source_path).st_mode
+        if not stat.S_ISREG(mode):
+            raise _special_file_error(source_path, mode)
+        fd, temp_path = _temp_sibling(target_path)
+        try:
+            with open(source_path, 'rb') as source, open(fd, 'wb') as target:
+                size = _copy_data(source.fileno(), target.fileno())
+            shutil.copystat(source_path, temp_path)
+            os.replace(temp_path, target_path)
+        except:
+            os.remove(temp_path)
+            raise
+        return source_path, size, None
+    except Exception as error:
+        return source_path, None, error
+
+def _hashes_differ(pair):
+    source_path, target_path = pair
+    return pair, file_hash(source_path) != file_hash(target_path)
+
+def _mtimes(source_directory, target_directory):
+    return [os.stat(source_directory).st_mtime_ns, os.stat(target_directory).st_mtime_ns]
+
+def sync_tree(source_path, target_path, checksum=False, delete=False, dry_run=False,
+        workers=None, mtime_window=0, quiet=True, manifest=None):
+    """make the target directory a mirror of the source one copying only
+    new files and files whose size or mtime (more than 'mtime_window' seconds apart)
+    differ (with checksum=True: size or content hash); both trees are listed
+    once with os.scandir, subtrees missing in the target are copied whole
+    (copy_tree) without comparing, extraneous items are removed if delete=True;
+    'manifest' -- path of a json file with mtimes of the directory pairs after the
+    last successful sync: files of a directory are not compared (nor stat'ed)
+    while both its mtimes are the same, only its subdirectories are visited;
+    NB: a file changed in place (without being created, renamed or removed)
+    does not change the mtime of its directory, so with the manifest it is
+    not noticed; return SyncPlan (only planned if dry_run)"""
+    source_path, target_path = abspath(source_path), abspath(target_path)
+    workers = workers or WORKERS
+    plan = SyncPlan(source_path, target_path)
+    options = [checksum, delete, mtime_window]
+    recorded = {} # relative directory path -> [source mtime, target mtime]
+    if manifest is not None and op.isfile(manifest):
+        with open(manifest) as file:
+            data = json.load(file)
+        if data.get('options') == options:
+            recorded = data['directories']
+    visited = {} # relative directory path -> (source directory, target directory)
+    if not op.isdir(target_path):
+        plan.trees.append((source_path, target_path))
+    else:
+        same_size = [] # (source, target) files to compare by content
+        stack = [(source_path, target_path)]
+        while stack:
+            source_directory, target_directory = stack.pop()
+            relative = source_directory[len(source_path) + 1:]
+            visited[relative] = (source_directory, target_directory)
+            if relative in recorded and recorded[relative] == _mtimes(source_directory, target_directory):
+                plan.pruned.append(source_directory)
+                with os.scandir(source_directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, concat(target_directory, entry.name)))
+                continue
+            with os.scandir(target_directory) as entries:
+                targets = {entry.name: entry for entry in entries}
+            with os.scandir(source_directory) as entries:
+                for entry in entries:
+                    target_entry = targets.pop(entry.name, None)
+                    target = concat(target_directory, entry.name)
+                    kind = _entry_kind(entry)
+                    if kind == 'special':
+                        plan.special.append(entry.path)
+                        continue
+                    if target_entry is not None and _entry_kind(target_entry) != kind:
+                        plan.replace.append(target)
+                        target_entry = None
+                    if kind == 'link':
+                        if target_entry is None or os.readlink(entry.path) != os.readlink(target):
+                            plan.links.append((entry.path, target))
+                    elif kind == 'directory':
+                        if target_entry is None:
+                            plan.trees.append((entry.path, target))
+                        else:
+                            stack.append((entry.path, target))
+                    elif target_entry is None:
+                        plan.files.append((entry.path, target))
+                    else:
+                        source_stat, target_stat = entry.stat(), target_entry.stat()
+                        if source_stat.st_size != target_stat.st_size:
+                            plan.files.append((entry.path, target))
+                        elif checksum:
+                            same_size.append((entry.path, target))
+                        elif abs(source_stat.st_mtime_ns - target_stat.st_mtime_ns) > mtime_window * 10**9:
+                            plan.files.append((entry.path, target))
+            plan.extraneous.extend(entry.path for entry in targets.values())
+        for pair, differ in imap_unordered(_hashes_differ, same_size, workers=workers):
+            if differ:
+                plan.files.append(pair)
+    if not quiet:
+        print(plan)
+    if dry_run:
+        return plan
+    start = time.monotonic()
+    report = plan.report = CopyReport()
+    for path in plan.special:
+        try:
+            report.errors[path] = _special_file_error(path, os.stat(path).st_mode)
+        except OSError as error:
+            report.errors[path] = error
+    for path in plan.replace + (plan.extraneous if delete else []):
+        try:
+            remove_path(path)
+        except OSError as error:
+            report.errors[path] = error
+    for source, target in plan.trees:
+        try:
+            tree_report = copy_tree(source, target, workers=workers, symlinks=True)
+        except OSError as error:
+            report.errors[source] = error
+            continue
+        report.results.update(tree_report.results)
+        report.errors.update(tree_report.errors)
+        report.bytes += tree_report.bytes
+        report.directories += tree_report.directories
+    for source, target in plan.links:
+        try:
+            if op.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(source), target)
+        except OSError as error:
+            report.errors[source] = error
+    for path, size, error in imap_unordered(_replace_file, plan.files, workers=workers):
+        if error is None:
+            report.results[path] = size
+            report.bytes += size
+        else:
+            report.errors[path] = error
+    report.seconds = time.monotonic() - start
+    invalidate_stat(target_path, recursive=True)
+    if manifest is not None and not report.errors:
+        directories = {}
+        for relative, pair in visited.items():
+            try:
+                directories[relative] = _mtimes(*pair)
+            except OSError:
+                pass
+        write_atomic(manifest, json.dumps({'options': options, 'directories': directories}), fsync=False)
+    if not quiet:
+        print(report)
+    return plan
+
+# duplicates finder
+
+class HashCache(object):
+    """persistent (SQLite) cache of file digests keyed by
+    (st_dev, st_ino, st_size, st_mtime_ns) and kind of digest;
+    path=None keeps it in memory only"""
+
+    def __init__(self, path=None):
+        if path is None:
+            self.path = ':memory:'
+        else:
+            self.path = abspath(path)
+            os.makedirs(op.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER, kind TEXT, digest TEXT,
+            PRIMARY KEY (dev, ino, size, mtime, kind))""")
+
+    def __repr__(self):
+        return "HashCache('{}')".format(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, key, kind):
+        """return cached digest for key = (dev, ino, size, mtime_ns) or None"""
+        row = self._db.execute("SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime=? AND kind=?",
+            tuple(key) + (kind,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, kind, digest):
+        self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", tuple(key) + (kind, digest))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+def sample_hash(path, sample_size=4096, algorithm='sha256'):
+    """return hex digest of the first and the last 'sample_size' bytes of the file"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as file:
+        digest.update(file.read(sample_size))
+        size = os.fstat(file.fileno()).st_size
+        if size > sample_size:
+            file.seek(max(sample_size, size - sample_size))
+            digest.update(file.read(sample_size))
+    return digest.hexdigest()
+
+def _refine(buckets, kind, func, cache, workers):
+    """split every bucket of inode keys by func(<path>) digest (cached by kind)
+    and return the buckets with more than one key"""
+    digests = {}
+    missing = []
+    for bucket in buckets:
+        for key, paths in bucket:
+            digest = cache.get(key, kind)
+            if digest is None:
+                missing.append((key, paths))
+            else:
+                digests[key] = digest
+    def compute(record):
+        key, paths = record
+        try:
+            return key, func(paths[0])
+        except OSError:
+            return key, None # vanished or not readable
+    for key, digest in imap_unordered(compute, missing, workers=workers):
+        if digest is not None:
+            digests[key] = digest
+            cache.put(key, kind, digest)
+    cache.commit()
+    refined = []
+    for bucket in buckets:
+        by_digest = {}
+        for key, paths in bucket:
+            if key in digests:
+                by_digest.setdefault(digests[key], []).append((key, paths))
+        refined.extend(sub for sub in by_digest.values() if len(sub) > 1)
+    return refined
+
+def find_duplicates(paths, cache_path=None, link=False, workers=None, min_size=1,
+        sample_size=4096, algorithm='sha256', quiet=True):
+    """return list of Groups of files with the same content among the paths:
+    files are bucketed by size, then by hash of their first and last 'sample_size'
+    bytes, and only files still colliding are hashed fully (on 'workers' threads);
+    digests are kept in HashCache at 'cache_path' so next runs hash only changed files;
+    hard links to one inode are hashed once; link=True replaces duplicates
+    with hard links to the first file of each group (via _Item.hardlink)"""
+    inodes = {} # (dev, ino, size, mtime_ns) -> paths
+    for path in paths:
+        path = abspath(path)
+        result = cached_stat(path, follow_symlinks=False)
+        if result is None or not stat.S_ISREG(result.st_mode) or result.st_size < min_size:
+            continue
+        inodes.setdefault((result.st_dev, result.st_ino, result.st_size, result.st_mtime_ns), []).append(path)
+    by_size = {}
+    for key, key_paths in inodes.items():
+        by_size.setdefault(key[2], []).append((key, sorted(key_paths)))
+    buckets = [bucket for bucket in by_size.values() if len(bucket) > 1]
+    workers = workers or WORKERS
+    cache = HashCache(cache_path)
+    try:
+        buckets = _refine(buckets, '{}:{}'.format(algorithm, sample_size),
+            lambda path: sample_hash(path, sample_size, algorithm), cache, workers)
+        sampled = [bucket for bucket in buckets if bucket[0][0][2] <= 2 * sample_size]
+        buckets = sampled + _refine([bucket for bucket in buckets if bucket[0][0][2] > 2 * sample_size],
+            algorithm, lambda path: file_hash(path, algorithm), cache, workers)
+    finally:
+        cache.close()
+    groups = []
+    for bucket in sorted(buckets, key=lambda bucket: bucket[0][1][0]):
+        bucket.sort(key=lambda record: record[1][0])
+        (first_key, first_paths), others = bucket[0], bucket[1:]
+        if link:
+            original = File(first_paths[0], quiet=True)
+            for key, key_paths in others:
+                if key[0] != first_key[0]:
+                    if not quiet:
+                        print("WARNING: {} is on another device, not linked".format(key_paths))
+                    continue
+                for path in key_paths:
+                    directory_path, name = op.split(path)
+                    temp_name = '.{}.{}.link'.format(name, os.getpid())
+                    original.hardlink(Directory(directory_path, quiet=True), temp_name)
+                    os.replace(concat(directory_path, temp_name), path)
+                    invalidate_stat(path)
+        group_paths = [path for key, key_paths in bucket for path in key_paths]
+        groups.append(Group((File(path, quiet=True) for path in group_paths),
+            name="duplicates of {}".format(group_paths[0])))
+    if not quiet:
+        print("{} groups of duplicates found".format(len(groups)))
+    return groups
+
+# fd-relative tree actions
+
+def _parse_mode(mode, corresponds):
+    if isinstance(mode, int):
+        return mode
+    # + see http://www.computerhope.com/unix/uchmod.htm
+    mode = mode[1:]
+    ugo = [0, 0, 0] # oct 0o000
+    for i, m in enumerate([mode[i: i + 3] for i in range(0, len(mode), 3)]):
+        for ch in m:
+            ugo[i] += corresponds[ch]
+    return int("{}{}{}".format(*ugo), 8)
+
+def file_mode(mode):
+    """'-rwxr-x--x' (see File.chmod) --> 0o751"""
+    return _parse_mode(mode, {'-': 0, 'x': 1, 'w': 2, 'r': 4})
+
+def directory_mode(mode):
+    """'-cal-al--l' (see Directory.chmod) --> 0o751"""
+    return _parse_mode(mode, {'-': 0, 'a': 1, 'c': 2, 'l': 4})
+
+def _apply_entries(names, dir_fd, action):
+    changed = skipped = 0
+    for name in names:
+        try:
+            result = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        done = action(name, dir_fd, result)
+        if done:
+            changed += 1
+        elif done is not None:
+            skipped += 1
+    return changed, skipped
+
+def _apply_tree(directory_path, action):
+    """action for everything inside the directory, bottom-up with os.fwalk"""
+    changed = skipped = 0
+    for _, dirnames, filenames, dir_fd in os.fwalk(directory_path, topdown=False):
+        c, s = _apply_entries(filenames + dirnames, dir_fd, action)
+        changed += c
+        skipped += s
+    return changed, skipped
+
+def apply_inside(directory_path, action, workers=None):
+    """call action(<name>, <dir_fd>, <lstat result>) for everything inside
+    the directory (children before their directory); action returns True if it
+    changed something, False if the entry was already right, None if ignored;
+    top-level subdirectories go to 'workers' threads (1 -- all here);
+    return (<number of changed>, <number of skipped>)"""
+    directory_path = abspath(directory_path)
+    workers = workers or WORKERS
+    dir_fd = os.open(directory_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        with os.scandir(dir_fd) as entries:
+            names = []
+            subdirectories = []
+            for entry in entries:
+                names.append(entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(concat(directory_path, entry.name))
+        changed = skipped = 0
+        for c, s in imap_unordered(lambda path: _apply_tree(path, action), subdirectories, workers=workers):
+            changed += c
+            skipped += s
+        c, s = _apply_entries(names, dir_fd, action)
+    finally:
+        os.close(dir_fd)
+    invalidate_stat(directory_path, recursive=True)
+    return changed + c, skipped + s
+
+# archives
+
+def _gzip_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # 31: gzip header and trailer
+    return compressor.compress(block) + compressor.flush()
+
+class ParallelGzipWriter(object):
+    """Write-only file object producing gzip: the data is cut into 'block_size'
+    blocks compressed as independent gzip members on 'workers' threads
+    (zlib releases the GIL) and written in order; concatenated members
+    are a valid gzip file for gunzip and the gzip module
+    (but not for tarfile stream mode 'r|gz', use 'r:gz')"""
+
+    def __init__(self, file, level=6, block_size=1 << 20, workers=None):
+        self._own = isinstance(file, str)
+        self._file = open(abspath(file), 'wb') if self._own else file
+        self.level = level
+        self.block_size = block_size
+        workers = workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(workers)
+        self._pending = deque()
+        self._max_pending = 2 * workers
+        self._buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def __repr__(self):
+        return "ParallelGzipWriter({!r}, level={})".format(self._file, self.level)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(_gzip_member, block, self.level))
+        while len(self._pending) > self._max_pending:
+            self._write_member(self._pending.popleft().result())
+
+    def _write_member(self, member):
+        self._file.write(member)
+        self.bytes_out += len(member)
+
+    def flush(self):
+        """write all the complete blocks"""
+        while self._pending:
+            self._write_member(self._pending.popleft().result())
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer or not self.bytes_in:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        self.flush()
+        self._pool.shutdown()
+        if self._own:
+            self._file.close()
+        self.closed = True
+
+class ArchiveReport(CopyReport):
+    """CopyReport of archiving: 'results' = {<member name>: <bytes>},
+    'compressed' -- size of the archive"""
+
+    def __init__(self):
+        CopyReport.__init__(self)
+        self.compressed = 0
+
+    def __repr__(self):
+        return "<ArchiveReport: {} members, {} bytes ({} compressed) in {:.2f}s ({:.1f} MB/s), {} failed>".format(
+            len(self.results), self.bytes, self.compressed, self.seconds, self.throughput / 1e6, len(self.errors))
+
+def make_tar_gz(path, archive_path, arcname=None, level=6, workers=None, block_size=1 << 20):
+    """write tar.gz of the file or directory with the path: tar entries are
+    streamed straight into ParallelGzipWriter (no temporary tar);
+    return ArchiveReport"""
+    start = time.monotonic()
+    path, archive_path = abspath(path), abspath(archive_path)
+    report = ArchiveReport()
+    def count(member):
+        report.results[member.name] = member.size
+        report.bytes += member.size
+        return member
+    with open(archive_path, 'wb') as raw:
+        with ParallelGzipWriter(raw, level=level, block_size=block_size, workers=workers) as gzip:
+            with tarfile.open(fileobj=gzip, mode='w|') as tar:
+                tar.add(path, arcname=path2name(path) if arcname is None else arcname, filter=count)
+    report.compressed = gzip.bytes_out
+    report.seconds = time.monotonic() - start
+    invalidate_stat(archive_path)
+    return report
+
+def _checked_member(member, target_path):
+    """refuse absolute paths, '..' and links outside the target (tarfile 'data' filter)"""
+    if hasattr(tarfile, 'data_filter'):
+        return tarfile.data_filter(member, target_path)
+    destination = op.realpath(op.join(target_path, member.name))
+    if not (destination + SEP).startswith(op.realpath(target_path) + SEP):
+        raise tarfile.TarError("{} is outside the target directory".format(member.name))
+    return member
+
+def _open_decompressed(path):
+    """open (compressed) file for reading by its magic bytes;
+    gzip module (unlike tarfile stream mode) reads multi-member gzip"""
+    with open(path, 'rb') as file:
+        magic = file.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(path, 'rb')
+    if magic.startswith(b'BZh'):
+        return bz2.open(path, 'rb')
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+def _write_member(destination, data, mode, mtime):
+    with open(destination, 'wb') as file:
+        file.write(data)
+    os.chmod(destination, mode)
+    os.utime(destination, (mtime, mtime))
+    return len(data)
+
+def _extract_tar(archive_path, target_path, report, workers, inline_size):
+    """members are read sequentially from the (decompressed) stream,
+    small files are written by the worker threads, large ones here;
+    of members with the same name (appended archives) the last one wins"""
+    directories = []
+    links = OrderedDict() # destination -> link member
+    pending = deque()
+    writing = {} # destination -> future of its last submitted write
+    in_flight = 0
+    with ThreadPoolExecutor(workers) as pool, _open_decompressed(archive_path) as stream, \
+            tarfile.open(fileobj=stream, mode='r|') as tar:
+        for member in tar:
+            member = _checked_member(member, target_path)
+            destination = op.join(target_path, member.name)
+            if member.isdir():
+                os.makedirs(destination, exist_ok=True)
+                directories.append((destination, member))
+            elif member.isreg():
+                os.makedirs(op.dirname(destination), exist_ok=True)
+                links.pop(destination, None)
+                previous = writing.pop(destination, None)
+                if previous is not None:
+                    previous.result() # an earlier member with the same name must be written first
+                source = tar.extractfile(member)
+                mode = member.mode if member.mode is not None else 0o644
+                if member.size <= inline_size:
+                    future = writing[destination] = pool.submit(_write_member, destination, source.read(), mode, member.mtime)
+                    pending.append((member.name, destination, future))
+                    in_flight += member.size
+                    while pending and (in_flight > 16 * inline_size or len(pending) > 4 * workers):
+                        name, written, future = pending.popleft()
+                        size = future.result()
+                        if writing.get(written) is future:
+                            del writing[written]
+                        in_flight -= size
+                        report.results[name] = size
+                        report.bytes += size
+                else:
+                    with open(destination, 'wb') as file:
+                        shutil.copyfileobj(source, file, CHUNK_SIZE)
+                    os.chmod(destination, mode)
+                    os.utime(destination, (member.mtime, member.mtime))
+                    report.results[member.name] = member.size
+                    report.bytes += member.size
+            elif member.issym() or member.islnk():
+                links.pop(destination, None)
+                links[destination] = member
+        for name, _, future in pending:
+            size = future.result()
+            report.results[name] = size
+            report.bytes += size
+    for destination, member in links.items():
+        os.makedirs(op.dirname(destination), exist_ok=True)
+        if op.lexists(destination):
+            os.remove(destination)
+        if member.issym():
+            os.symlink(member.linkname, destination)
+        else:
+            os.link(op.join(target_path, member.linkname), destination)
+        report.results[member.name] = 0
+    for destination, member in reversed(directories):
+        if member.mode is not None:
+            os.chmod(destination, member.mode)
+        os.utime(destination, (member.mtime, member.mtime))
+
+def _extract_zip(archive_path, target_path, report, workers):
+    """members are independent: every worker thread opens the archive once
+    and decompresses its members"""
+    local = threading.local()
+    opened = []
+    def extract(info):
+        archive = getattr(local, 'archive', None)
+        if archive is None:
+            archive = local.archive = zipfile.ZipFile(archive_path)
+            opened.append(archive)
+        archive.extract(info, target_path)
+        return info.filename, info.file_size
+    with zipfile.ZipFile(archive_path) as archive:
+        infos = archive.infolist()
+    try:
+        for name, size in imap_unordered(extract, infos, workers=workers):
+            report.results[name] = size
+            report.bytes += size
+    finally:
+        for archive in opened:
+            archive.close()
+
+def extract_archive(archive_path, target_path='.', workers=None, inline_size=1 << 22):
+    """extract zip (members decompressed concurrently) or tar, tar.gz, tar.bz2,
+    tar.xz (one decompression stream, files written concurrently) archive
+    into the target directory; return ArchiveReport"""
+    start = time.monotonic()
+    archive_path, target_path = abspath(archive_path), abspath(target_path)
+    workers = workers or WORKERS
+    report = ArchiveReport()
+    report.compressed = op.getsize(archive_path)
+    os.makedirs(target_path, exist_ok=True)
+    if zipfile.is_zipfile(archive_path):
+        _extract_zip(archive_path, target_path, report, workers)
+    else:
+        _extract_tar(archive_path, target_path, report, workers, inline_size)
+    report.seconds = time.monotonic() - start
+    invalidate_stat(target_path, recursive=True)
+    return report
+
+# archive views
+
+class ArchiveIndex(object):
+    """Index of members of a zip or tar archive built once:
+    {<member path>: (<size>, <ZipInfo or TarInfo>)} and children of every
+    (also implicit) directory; tar members keep their data offsets, so
+    reading a member of an uncompressed tar seeks straight to it;
+    the archive is kept open until close() and reopened on demand"""
+
+    def __init__(self, path):
+        self.path = abspath(path)
+        result = os.stat(self.path)
+        self.signature = (result.st_mtime_ns, result.st_size)
+        self.members = {}
+        self.children = {'': set()}
+        self._lock = threading.Lock()
+        self._zip = zipfile.is_zipfile(self.path)
+        if self._zip:
+            self._archive = zipfile.ZipFile(self.path)
+            for info in self._archive.infolist():
+                self._add(info.filename, info.file_size, None if info.is_dir() else info)
+        else:
+            self._archive = tarfile.open(self.path, 'r:*')
+            for info in self._archive.getmembers():
+                if info.isdir():
+                    self._add(info.name, 0, None)
+                elif info.isreg() or info.islnk() or info.issym():
+                    self._add(info.name, info.size, info)
+        self._sizes = {}
+
+    def __repr__(self):
+        return "ArchiveIndex('{}', {} members)".format(self.path, len(self.members))
+
+    def _add(self, name, size, info):
+        parts = [part for part in name.split('/') if part and part != '.']
+        for i in range(len(parts)):
+            directory, child = '/'.join(parts[:i]), parts[i]
+            self.children.setdefault(directory, set()).add(child)
+            if i < len(parts) - 1:
+                self.children.setdefault('/'.join(parts[:i + 1]), set())
+        if info is not None and parts:
+            self.members['/'.join(parts)] = (size, info)
+        elif parts:
+            self.children.setdefault('/'.join(parts), set())
+
+    def is_directory(self, name):
+        return name in self.children
+
+    def size(self, name):
+        """size of the member or total size of the members inside the directory"""
+        if name in self.members:
+            return self.members[name][0]
+        if name not in self._sizes:
+            prefix = name + '/' if name else ''
+            self._sizes[name] = sum(size for member, (size, _) in self.members.items() if member.startswith(prefix))
+        return self._sizes[name]
+
+    def open(self, name):
+        """return binary file object streaming the member"""
+        info = self.members[name][1]
+        with self._lock:
+            if self._archive is None:
+                result = os.stat(self.path)
+                if (result.st_mtime_ns, result.st_size) != self.signature:
+                    raise ValueError("archive '{}' was changed, index it again".format(self.path))
+                self._archive = zipfile.ZipFile(self.path) if self._zip else tarfile.open(self.path, 'r:*')
+            if self._zip:
+                return self._archive.open(info)
+            return self._archive.extractfile(info)
+
+    def close(self):
+        """close the archive file (the index is kept, members reopen it);
+        streams of tar members opened before become unusable"""
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+
+ARCHIVE_CACHE_SIZE = 16 # max number of indexed archives kept by archive_index()
+
+_archive_indexes = OrderedDict() # archive path -> ArchiveIndex, least recently used first
+_archive_indexes_lock = threading.Lock()
+
+def archive_index(path):
+    """return cached ArchiveIndex of the archive (rebuilt if the file changed);
+    least recently used indexes are closed and dropped"""
+    path = abspath(path)
+    result = os.stat(path)
+    with _archive_indexes_lock:
+        index = _archive_indexes.pop(path, None)
+        if index is not None and index.signature != (result.st_mtime_ns, result.st_size):
+            index.close()
+            index = None
+        if index is None:
+            index = ArchiveIndex(path)
+        _archive_indexes[path] = index
+        while len(_archive_indexes) > ARCHIVE_CACHE_SIZE:
+            _archive_indexes.popitem(last=False)[1].close()
+    return index
+
+class ArchiveMember(object):
+    """Read-only File-like member of an archive, its content is streamed
+    from the archive on demand"""
+
+    def __init__(self, index, name):
+        self._index = index
+        self._name = name
+
+    def __repr__(self):
+        return "ArchiveMember('{}', '{}')".format(self._index.path, self._name)
+
+    def __str__(self):
+        return "<ArchiveMember '{}' in '{}'>".format(self._name, self._index.path)
+
+    def __len__(self):
+        return self.charlen()
+
+    def __contains__(self, x):
+        return any(x in line for line in self.lines())
+
+    def open(self):
+        """return binary file object"""
+        return self._index.open(self._name)
+
+    def chunks(self, size=CHUNK_SIZE, encoding=None, binary=False):
+        """iterate over consecutive pieces of the member, see File.chunks"""
+        with self.open() as raw:
+            file = raw if binary else io.TextIOWrapper(raw, encoding=encoding)
+            chunk = file.read(size)
+            while chunk:
+                yield chunk
+                chunk = file.read(size)
+
+    def lines(self, encoding=None, binary=False):
+        """iterate over strings of the member, see File.lines"""
+        with self.open() as raw:
+            for line in (raw if binary else io.TextIOWrapper(raw, encoding=encoding)):
+                yield line
+
+    def get_text(self, encoding=None):
+        return ''.join(self.chunks(encoding=encoding))
+
+    def get_bytes(self):
+        return b''.join(self.chunks(binary=True))
+
+    def charlen(self, encoding=None):
+        return sum(map(len, self.chunks(encoding=encoding)))
+
+    def find(self, string, every=False, quiet=True):
+        """like File.find"""
+        text = self.get_text()
+        result = text.find(string)
+        if result == -1 and not quiet:
+            print("String {} was not found, -1 returned.".format(string))
+        if not every:
+            return result
+        results = []
+        while result != -1:
+            results.append(result)
+            result = text.find(string, result + (len(string) or 1))
+        return results
+
+    def extract(self, directory, new_name=None):
+        """copy the member to a Directory and return the File"""
+        path = concat(directory.path, new_name or self.name)
+        with self.open() as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+        invalidate_stat(path)
+        return File(path)
+
+    def get_size(self):
+        return self._index.size(self._name)
+
+    def exist(self):
+        return True
+
+    def is_file(self):
+        return True
+
+    def is_directory(self):
+        return False
+
+    @property
+    def name(self):
+        return self._name.rsplit('/', 1)[-1]
+
+    @property
+    def path(self):
+        return concat(self._index.path, self._name)
+
+    @property
+    def ext(self):
+        return op.splitext(self.name)[1][1:]
+
+    @property
+    def size(self):
+        return self.get_size()
+
+    @property
+    def text(self):
+        return self.get_text()
+
+class ArchiveDirectory(object):
+    """Read-only Directory-like view of a directory inside an archive
+    (the archive root by default), see File.archive"""
+
+    def __init__(self, index, name=''):
+        self._index = index
+        self._name = name
+
+    def __repr__(self):
+        return "ArchiveDirectory('{}', '{}')".format(self._index.path, self._name)
+
+    def __str__(self):
+        return "<ArchiveDirectory '{}' in '{}'>".format(self._name, self._index.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """close the archive file (it is reopened if members are read later)"""
+        self._index.close()
+
+    def __len__(self):
+        return len(self._index.children[self._name])
+
+    def __iter__(self):
+        return iter(self.get_items())
+
+    def __contains__(self, x):
+        return (x.name if hasattr(x, 'name') else x) in self._index.children[self._name]
+
+    def __truediv__(self, name):
+        return self.down(name)
+
+    def __getitem__(self, name):
+        return self.down(name)
+
+    def _member(self, name):
+        return '/'.join(part for part in (self._name, name.strip('/')) if part)
+
+    def down(self, name):
+        """return the member or subdirectory inside with given name (or relative path)"""
+        member = self._member(name)
+        if self._index.is_directory(member):
+            return ArchiveDirectory(self._index, member)
+        if member in self._index.members:
+            return ArchiveMember(self._index, member)
+        raise KeyError("'{}' is not in {}".format(name, self))
+
+    def ls(self):
+        """return sorted names inside"""
+        return sorted(self._index.children[self._name])
+
+    def get_names(self):
+        return self.ls()
+
+    def get_items(self):
+        return [self.down(name) for name in self.ls()]
+
+    def group(self):
+        return Group(self.get_items(), name=self.name)
+
+    def get_size(self):
+        """total size of the members inside (uncompressed)"""
+        return self._index.size(self._name)
+
+    def exist(self):
+        return True
+
+    def is_file(self):
+        return False
+
+    def is_directory(self):
+        return True
+
+    @property
+    def name(self):
+        return self._name.rsplit('/', 1)[-1] if self._name else path2name(self._index.path)
+
+    @property
+    def path(self):
+        return concat(self._index.path, self._name) if self._name else self._index.path
+
+    @property
+    def size(self):
+        return self.get_size()
+
+# asyncio layer
+
+AIO_LIMITS = {'stat': 256, 'list': 32, 'read': 64, 'write': 32, 'tree': 4, 'io': 64}
+# max number of simultaneously running blocking calls of each kind of operation
+
+_AIO_KINDS = {
+    'stat': ('exist', 'is_file', 'is_directory', 'is_link', 'info', 'what_is', 'get_size', 'size'),
+    'list': ('get_items', 'get_names', 'get_paths', 'ls', 'listing', 'page', 'group', 'choose',
+             'items', 'names', 'paths', 'archive'),
+    'read': ('get_text', 'text', 'charlen', 'strlen', 'find', 'search', 'get_hash', 'print_text'),
+    'write': ('set_text', 'append', 'insert', 'clear', 'create', 'rewrite', 'rename', 'chmod', 'chown',
+              'hardlink', 'symlink', 'delete', 'remove', 'copy', 'copy_to', 'move'),
+}
+_AIO_KINDS = {name: kind for kind, names in _AIO_KINDS.items() for name in names}
+# on a Directory or Group these walk whole trees
+_AIO_TREE = {'get_size', 'size', 'du', 'copy', 'copy_to', 'move', 'delete', 'empty', 'insert', 'sync_to',
+             'make_archive', 'unpack_archive', 'duplicates', 'grep', 'chmod_inside', 'chown_inside',
+             'apply', 'rename_all', 'strip', 'cut', 'index'}
+_AIO_PLAIN = {'name', 'path', 'ext', 'directory', 'report'} # cheap attributes returned as is
+
+class AioRunner(object):
+    """Bounded thread pool for blocking filesystem calls made from asyncio code,
+    every kind of operation (see AIO_LIMITS) has its own concurrency limit,
+    so e.g. a few tree copies can't take all threads from small reads"""
+
+    def __init__(self, workers=None, limits=None):
+        self.workers = workers or WORKERS
+        self.limits = dict(AIO_LIMITS, **(limits or {}))
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='aio')
+        self._semaphores = weakref.WeakKeyDictionary() # event loop -> {kind: asyncio.Semaphore}
+
+    def __repr__(self):
+        return "AioRunner(workers={}, limits={})".format(self.workers, self.limits)
+
+    def _semaphore(self, loop, kind):
+        semaphores = self._semaphores.setdefault(loop, {})
+        if kind not in semaphores:
+            semaphores[kind] = asyncio.Semaphore(self.limits.get(kind, self.limits['io']))
+        return semaphores[kind]
+
+    async def run(self, kind, func, *args, **kwargs):
+        """await func(*args, **kwargs) called in the pool"""
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(loop, kind):
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def iterate(self, kind, make_iterator, batch=256):
+        """async iterator over a blocking iterator, advanced in the pool by batches"""
+        iterator = await self.run(kind, make_iterator)
+        take = lambda: list(itertools.islice(iterator, batch))
+        try:
+            while True:
+                values = await self.run(kind, take)
+                if not values:
+                    break
+                for value in values:
+                    yield value
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+_aio_runner = None
+
+def aio_runner():
+    """return the default AioRunner (created on first use)"""
+    global _aio_runner
+    if _aio_runner is None:
+        _aio_runner = AioRunner()
+    return _aio_runner
+
+def set_aio_runner(workers=None, **limits):
+    """replace the default AioRunner, e.g. set_aio_runner(16, tree=2, read=128)"""
+    global _aio_runner
+    if _aio_runner is not None:
+        _aio_runner.shutdown(wait=False)
+    _aio_runner = AioRunner(workers, limits)
+    return _aio_runner
+
+def aio(item, runner=None):
+    """return awaitable mirror of File, Directory, Group or of the item at path"""
+    if isinstance(item, str):
+        item = Item(item)
+    if isinstance(item, File):
+        return AioFile(item, runner)
+    if isinstance(item, Directory):
+        return AioDirectory(item, runner)
+    if isinstance(item, Group):
+        return AioGroup(item, runner)
+    return item
+
+class _AioItem(object):
+    """Mirror of a File/Directory/Group: methods and properties that touch
+    the disk become awaitable, e.g. `text = await aio(file).get_text()`,
+    `size = await aio(directory).size`; underlying object is in .sync"""
+
+    _tree = False # whether _AIO_TREE operations are tree walks
+
+    def __init__(self, item, runner=None):
+        self.sync = item
+        self.runner = runner or aio_runner()
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.sync)
+
+    def __str__(self):
+        return str(self.sync)
+
+    def __eq__(self, other):
+        return isinstance(other, _AioItem) and self.sync == other.sync
+
+    def __hash__(self):
+        return hash(self.sync)
+
+    def _kind(self, name):
+        if self._tree and name in _AIO_TREE:
+            return 'tree'
+        return _AIO_KINDS.get(name, 'io')
+
+    def _wrap(self, result):
+        if isinstance(result, (File, Directory, Group)):
+            return aio(result, self.runner)
+        return result
+
+    async def _call(self, name, *args, **kwargs):
+        result = await self.runner.run(self._kind(name), getattr(self.sync, name), *args, **kwargs)
+        return self._wrap(result)
+
+    async def _get(self, name):
+        return self._wrap(await self.runner.run(self._kind(name), getattr, self.sync, name))
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in _AIO_PLAIN:
+            return self._wrap(getattr(self.sync, name))
+        attribute = getattr(type(self.sync), name, None)
+        if isinstance(attribute, property):
+            return self._get(name)
+        if callable(getattr(self.sync, name)):
+            return functools.partial(self._call, name)
+        return getattr(self.sync, name)
+
+class AioFile(_AioItem):
+    """awaitable File, see _AioItem"""
+
+    def lines(self, encoding=None, binary=False, batch=256):
+        """async iterator over strings of the file"""
+        return self.runner.iterate('read', lambda: self.sync.lines(encoding, binary), batch)
+
+    def chunks(self, size=CHUNK_SIZE, encoding=None, binary=False):
+        """async iterator over consecutive pieces of the file"""
+        return self.runner.iterate('read', lambda: self.sync.chunks(size, encoding, binary), 1)
+
+    def __aiter__(self):
+        return self.lines()
+
+class AioDirectory(_AioItem):
+    """awaitable Directory, see _AioItem"""
+
+    _tree = True
+
+    def scan(self, batch=256):
+        """async iterator over items inside (like Directory.scan)"""
+        return self._items(lambda: self.sync.scan(), batch)
+
+    def walk(self, batch=256):
+        """async iterator over every item inside the directory tree"""
+        return self._items(lambda: map(item_from_entry, walk_entries(self.sync.path)), batch)
+
+    async def _items(self, make_iterator, batch):
+        async for item in self.runner.iterate('list', make_iterator, batch):
+            yield aio(item, self.runner)
+
+    def __aiter__(self):
+        return self.scan()
+
+    def __truediv__(self, name):
+        return aio(self.sync / name, self.runner)
+
+    def __getitem__(self, name):
+        return aio(self.sync[name], self.runner)
+
+class AioGroup(_AioItem):
+    """awaitable Group, see _AioItem"""
+
+    _tree = True
+
+    def __iter__(self):
+        return (aio(item, self.runner) for item in self.sync)
+
+    def __len__(self):
+        return len(self.sync)
+
+    async def __aiter__(self):
+        for item in self.sync:
+            yield aio(item, self.runner)
+
+    async def gather(self, method, *args, **kwargs):
+        """call awaitable method of every item concurrently, return {<item>: <result>}
+        e.g. texts = await aio(group).gather('get_text')"""
+        items = list(self)
+        results = await asyncio.gather(*(getattr(item, method)(*args, **kwargs) for item in items))
+        return {item.sync: result for item, result in zip(items, results)}
+
+# delete engine
+
+_DIRECTORY_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_CLOEXEC', 0)
+
+def _delete_scan(parent_fd, name, expected):
+    """open the directory 'name' relative to parent_fd (or the path if parent_fd
+    is None) without following symlinks, check that it is the scanned one
+    ('expected' lstat result), unlink everything but subdirectories inside;
+    return (<fd>, <number of unlinked>, [(<subdirectory name>, <its lstat>)])"""
+    fd = os.open(name, _DIRECTORY_FLAGS, dir_fd=parent_fd)
+    try:
+        if not op.samestat(expected, os.fstat(fd)):
+            raise OSError(errno.ESTALE, "directory was replaced while deleting", name)
+        names = []
+        subdirectories = []
+        with os.scandir(fd) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append((entry.name, entry.stat(follow_symlinks=False)))
+                else:
+                    names.append(entry.name)
+        for name in names:
+            try:
+                os.unlink(name, dir_fd=fd)
+            except FileNotFoundError:
+                pass
+    except:
+        os.close(fd)
+        raise
+    return fd, len(names), subdirectories
+
+class _DeleteNode(object):
+    """scanned directory of delete_tree waiting for its subdirectories"""
+
+    def __init__(self, fd, parent, name, remaining):
+        self.fd = fd
+        self.parent = parent
+        self.name = name
+        self.remaining = remaining
+
+def delete_tree(path, workers=None, keep_root=False, progress=None):
+    """remove the directory tree: directories are scanned and their files
+    unlinked on 'workers' threads, every directory is removed as soon as all
+    its subdirectories are gone (bottom-up); everything below the root is
+    opened and removed relative to its parent's descriptor without following
+    symlinks and checked against the scanned inode (safe against symlink
+    swaps, like shutil.rmtree); directories are taken depth-first, so few
+    descriptors are open at once; keep_root=True empties the directory in place;
+    progress(<files removed>, <directories removed>) is called after every directory;
+    return (<files removed>, <directories removed>)"""
+    path = abspath(path)
+    expected = os.lstat(path)
+    if stat.S_ISLNK(expected.st_mode):
+        raise OSError(errno.ELOOP, "cannot delete a symbolic link as a directory tree", path)
+    workers = workers or WORKERS
+    files = directories = 0
+    stack = [(None, path, expected)] # (parent node, name, lstat) to scan
+    pending = {} # future -> parent node
+    nodes = [] # open nodes, to close on error
+    pool = ThreadPoolExecutor(workers)
+    try:
+        while stack or pending:
+            while stack and len(pending) < workers:
+                parent, name, expected = stack.pop()
+                pending[pool.submit(_delete_scan, parent and parent.fd, name, expected)] = (parent, name)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent, name = pending.pop(future)
+                fd, unlinked, subdirectories = future.result()
+                node = _DeleteNode(fd, parent, name, len(subdirectories))
+                nodes.append(node)
+                files += unlinked
+                stack.extend((node, subname, substat) for subname, substat in subdirectories)
+                while node.remaining == 0:
+                    if node.parent is None and keep_root:
+                        break
+                    os.close(node.fd)
+                    node.fd = None
+                    if node.parent is None:
+                        os.rmdir(path)
+                    else:
+                        os.rmdir(node.name, dir_fd=node.parent.fd)
+                    directories += 1
+                    if node.parent is None:
+                        break
+                    node = node.parent
+                    node.remaining -= 1
+                if progress is not None:
+                    progress(files, directories)
+            nodes = [node for node in nodes if node.fd is not None]
+    finally:
+        for future in pending:
+            try:
+                os.close(future.result()[0])
+            except Exception:
+                pass
+        pool.shutdown()
+        for node in nodes:
+            if node.fd is not None:
+                os.close(node.fd)
+        invalidate_stat(path, recursive=True)
+    return files, directories
+
+# lazy queries
+
+def _entry_stat(entry):
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+class GroupQuery(object):
+    """Lazy query over the items inside a directory (see Directory.query):
+    name/ext/type conditions are checked on os.DirEntry data, size/time ones
+    on its (cached) stat, and only the items passing all of them are built;
+    every method returns a new query, iterate it or call group() to run it"""
+
+    _COST_NAME, _COST_TYPE, _COST_STAT = 0, 1, 2
+
+    def __init__(self, directory_path='.'):
+        self._path = abspath(directory_path)
+        self._entry_rules = () # (cost, func(entry))
+        self._item_rules = () # func(item)
+        self._prunes = () # func(entry) -> True to skip the subdirectory
+        self._depth = 0 # 0 -- only the directory itself, None -- unlimited
+
+    def __repr__(self):
+        return "GroupQuery('{}', {} conditions, depth={})".format(self._path,
+            len(self._entry_rules) + len(self._item_rules), self._depth)
+
+    def _with(self, entry_rule=None, item_rule=None, prune=None, depth=False):
+        query = GroupQuery.__new__(GroupQuery)
+        query.__dict__.update(self.__dict__)
+        if entry_rule is not None:
+            query._entry_rules = tuple(sorted(self._entry_rules + (entry_rule,), key=lambda rule: rule[0]))
+        if item_rule is not None:
+            query._item_rules = self._item_rules + (item_rule,)
+        if prune is not None:
+            query._prunes = self._prunes + (prune,)
+        if depth is not False:
+            query._depth = depth
+        return query
+
+    def name(self, pattern):
+        """name matches glob pattern (or is equal)"""
+        match = re.compile(fnmatch.translate(pattern)).match
+        return self._with(entry_rule=(self._COST_NAME, lambda entry: match(entry.name) is not None))
+
+    def contains(self, part_of_name):
+        """name contains the string"""
+        return self._with(entry_rule=(self._COST_NAME, lambda entry: part_of_name in entry.name))
+
+    def ext(self, *exts):
+        """file with one of the extensions (without dot)"""
+        exts = frozenset(exts)
+        return self._with(entry_rule=(self._COST_NAME,
+            lambda entry: op.splitext(entry.name)[1][1:] in exts and not entry.is_dir()))
+
+    def files(self):
+        return self._with(entry_rule=(self._COST_TYPE, lambda entry: not entry.is_dir()))
+
+    def directories(self):
+        return self._with(entry_rule=(self._COST_TYPE, lambda entry: entry.is_dir()))
+
+    def _stat_rule(self, test):
+        def rule(entry):
+            result = _entry_stat(entry)
+            return result is not None and test(result)
+        return self._with(entry_rule=(self._COST_STAT, rule))
+
+    def larger_than(self, size):
+        return self._stat_rule(lambda result: result.st_size > size)
+
+    def smaller_than(self, size):
+        return self._stat_rule(lambda result: result.st_size < size)
+
+    def newer_than(self, timestamp):
+        """modified after the timestamp (seconds, like os.stat st_mtime)"""
+        return self._stat_rule(lambda result: result.st_mtime > timestamp)
+
+    def older_than(self, timestamp):
+        return self._stat_rule(lambda result: result.st_mtime < timestamp)
+
+    def where(self, rule):
+        """rule(<item>) for already built items (checked last)"""
+        return self._with(item_rule=rule)
+
+    def recursive(self, max_depth=None):
+        """look inside subdirectories too (up to 'max_depth' levels, None -- all)"""
+        return self._with(depth=max_depth)
+
+    def prune(self, pattern):
+        """do not look inside subdirectories with names matching glob pattern
+        (or for which pattern(<os.DirEntry>) is True)"""
+        if callable(pattern):
+            return self._with(prune=pattern)
+        match = re.compile(fnmatch.translate(pattern)).match
+        return self._with(prune=lambda entry: match(entry.name) is not None)
+
+    def __iter__(self):
+        entry_rules = [rule for cost, rule in self._entry_rules]
+        item_rules = self._item_rules
+        prunes = self._prunes
+        stack = [(self._path, 0)]
+        while stack:
+            directory_path, depth = stack.pop()
+            try:
+                entries = os.scandir(directory_path)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if (self._depth is None or depth < self._depth) and entry.is_dir(follow_symlinks=False) \
+                            and not any(prune(entry) for prune in prunes):
+                        stack.append((entry.path, depth + 1))
+                    if all(rule(entry) for rule in entry_rules):
+                        item = item_from_entry(entry)
+                        if all(rule(item) for rule in item_rules):
+                            yield item
+
+    def group(self, name=None):
+        """run the query, return Group"""
+        return Group(self, name=name or "query of {}".format(path2name(self._path)))
+
+    def paths(self):
+        return [item.path for item in self]
+
+    def count(self):
+        return sum(1 for _ in self)
+
+    def first(self):
+        """return the first found item or None"""
+        return next(iter(self), None)
+
+def query(directory_path='.'):
+    """return lazy GroupQuery over the items inside the directory with the path"""
+    return GroupQuery(directory_path)
+
+# tree index
+
+class TreeIndex(object):
+    """SQLite index of a directory tree (path, name, ext, size, mtime, mode, inode)
+    answering queries as Groups without walking the tree;
+    refresh() relists only directories whose mtime changed
+    (so changes of file contents in unchanged directories are seen
+    only by refresh(full=True)); db_path=None keeps it in memory"""
+
+    def __init__(self, directory_path, db_path=None):
+        self._path = abspath(directory_path)
+        if db_path is None:
+            self.db_path = ':memory:'
+        else:
+            self.db_path = abspath(db_path)
+            os.makedirs(op.dirname(self.db_path), exist_ok=True)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY, parent TEXT, name TEXT, ext TEXT, size INTEGER,
+                mtime INTEGER, mode INTEGER, inode INTEGER, is_dir INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+            CREATE INDEX IF NOT EXISTS entries_ext ON entries (ext, size);
+            CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+            CREATE INDEX IF NOT EXISTS entries_mtime ON entries (mtime);
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER);""")
+
+    def __repr__(self):
+        return "TreeIndex('{}', '{}')".format(self._path, self.db_path)
+
+    def __len__(self):
+        return self._db.execute("SELECT count(*) FROM entries").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def _forget(self, path):
+        """remove the path and everything inside from the index"""
+        low, high = path + SEP, path + chr(ord(SEP) + 1)
+        self._db.execute("DELETE FROM entries WHERE path = ? OR (path > ? AND path < ?)", (path, low, high))
+        self._db.execute("DELETE FROM dirs WHERE path = ? OR (path > ? AND path < ?)", (path, low, high))
+
+    def refresh(self, full=False):
+        """bring the index up to date; return number of relisted directories"""
+        db = self._db
+        known = dict(db.execute("SELECT path, mtime FROM dirs"))
+        relisted = 0
+        stack = [self._path]
+        while stack:
+            directory_path = stack.pop()
+            result = _stat(directory_path, follow_symlinks=False)
+            if result is None or not stat.S_ISDIR(result.st_mode):
+                self._forget(directory_path)
+                continue
+            if not full and known.get(directory_path) == result.st_mtime_ns:
+                stack.extend(path for (path,) in db.execute(
+                    "SELECT path FROM entries WHERE parent = ? AND is_dir = 1", (directory_path,)))
+                continue
+            relisted += 1
+            rows = []
+            try:
+                with os.scandir(directory_path) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        is_dir = stat.S_ISDIR(st.st_mode)
+                        ext = '' if is_dir else op.splitext(entry.name)[1][1:]
+                        rows.append((entry.path, directory_path, entry.name, ext, st.st_size,
+                            st.st_mtime_ns, st.st_mode, st.st_ino, int(is_dir)))
+                        if is_dir:
+                            stack.append(entry.path)
+            except OSError:
+                continue
+            paths = set(row[0] for row in rows)
+            for (path,) in db.execute("SELECT path FROM entries WHERE parent = ?", (directory_path,)).fetchall():
+                if path not in paths:
+                    self._forget(path)
+            db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (directory_path, result.st_mtime_ns))
+        db.commit()
+        return relisted
+
+    def query(self, name=None, name_contains=None, ext=None, type=None, min_size=None, max_size=None,
+            newer=None, older=None, under=None, limit=None):
+        """return Group of the indexed items matching all the given conditions:
+        'name' -- exact name or glob pattern ('*.log'), 'ext' -- extension without dot,
+        'type' -- 'file' or 'directory', sizes in bytes, 'newer'/'older' -- timestamps
+        (seconds, like os.stat st_mtime), 'under' -- path of a directory inside"""
+        conditions = []
+        parameters = []
+        if name is not None:
+            conditions.append("name GLOB ?" if any(c in name for c in '*?[') else "name = ?")
+            parameters.append(name)
+        if name_contains is not None:
+            conditions.append("instr(name, ?) > 0")
+            parameters.append(name_contains)
+        if ext is not None:
+            conditions.append("ext = ?")
+            parameters.append(ext)
+        if type is not None:
+            conditions.append("is_dir = ?")
+            parameters.append(int(type == 'directory'))
+        if min_size is not None:
+            conditions.append("size >= ?")
+            parameters.append(min_size)
+        if max_size is not None:
+            conditions.append("size <= ?")
+            parameters.append(max_size)
+        if newer is not None:
+            conditions.append("mtime > ?")
+            parameters.append(int(newer * 10**9))
+        if older is not None:
+            conditions.append("mtime < ?")
+            parameters.append(int(older * 10**9))
+        if under is not None:
+            under = abspath(under)
+            conditions.append("path > ? AND path < ?")
+            parameters.extend((under + SEP, under + chr(ord(SEP) + 1)))
+        sql = "SELECT path, is_dir FROM entries"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+        items = ((Directory if is_dir else File).from_path(path) for path, is_dir in self._db.execute(sql, parameters))
+        return Group(items, name="query of {}".format(self._path))
+
+    def stat(self, path):
+        """return (size, mtime_ns, mode, inode) of the indexed path or None"""
+        return self._db.execute("SELECT size, mtime, mode, inode FROM entries WHERE path = ?",
+            (abspath(path),)).fetchone()
+
+# du engine
+
+def _du_scan(path, apparent):
+    """scan one directory: return (own size, [((dev, ino), size), ...] for
+    hard links, [subdirectory paths], error or None)"""
+    own = 0
+    links = []
+    subdirs = []
+    try:
+        st = os.lstat(path)
+        own = st.st_size if apparent else st.st_blocks * 512
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                size = st.st_size if apparent else st.st_blocks * 512
+                if st.st_nlink > 1:
+                    links.append(((st.st_dev, st.st_ino), size))
+                else:
+                    own += size
+    except OSError as error:
+        return own, links, subdirs, error
+    return own, links, subdirs, None
+
+def du(path='.', apparent=True, workers=None, quiet=True):
+    """return dict {<directory path>: <total size>} for the directory with the path
+    and every directory inside, a-la $ du -b (apparent=True) or $ du (allocated blocks);
+    directories are scanned iteratively on a thread pool of 'workers' threads,
+    every (st_dev, st_ino) pair is counted once, symlinks are not followed"""
+    path = abspath(path)
+    if not op.isdir(path) or op.islink(path):
+        st = os.lstat(path)
+        return {path: st.st_size if apparent else st.st_blocks * 512}
+    seen = set()
+    totals = {}
+    parents = {}
+    order = [] # parents are always finished before their children
+    with ThreadPoolExecutor(workers or WORKERS) as pool:
+        pending = {pool.submit(_du_scan, path, apparent): path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory_path = pending.pop(future)
+                own, links, subdirs, error = future.result()
+                if error is not None and not quiet:
+                    print("WARNING: {}".format(error))
+                for key, size in links:
+                    if key not in seen:
+                        seen.add(key)
+                        own += size
+                totals[directory_path] = own
+                order.append(directory_path)
+                for subdir in subdirs:
+                    parents[subdir] = directory_path
+                    pending[pool.submit(_du_scan, subdir, apparent)] = subdir
+    for directory_path in reversed(order):
+        if directory_path in parents:
+            totals[parents[directory_path]] += totals[directory_path]
+    return totals
+
 # often used functions
 _true = lambda x: True
 
 _item_exist = lambda item: item.exist()
+_item_get_size = lambda item: item.get_size()
 _item_path = lambda item: item.path
 _item_name = lambda item: item.name
 _item_name_is = lambda name: (lambda item: item.name == name)
@@ -1079,6 +4446,19 @@ _item_is_directory = lambda item: isinstance(item, Directory)
 _item_is_link = lambda item: op.islink(item._path)
 _item_attr = lambda name: (lambda item: getattr(item, name))
 
+def _item_stat_key(func):
+    def key(item):
+        result = cached_stat(item.path)
+        return None if result is None else func(result)
+    return key
+
+GROUP_KEYS = { # fast keys for Group.group_by (stat through the stat cache)
+    'ext': lambda item: op.splitext(item.name)[1][1:] if isinstance(item, File) else None,
+    'parent': lambda item: op.dirname(item.path),
+    'size': _item_stat_key(lambda result: 1 << result.st_size.bit_length()),
+    'mtime_day': _item_stat_key(lambda result: datetime.date.fromtimestamp(result.st_mtime)),
+}
+
 _path_exist = lambda path: op.exists(path)
 _path_name = lambda path: op.split(path)[-1]
 _path_ext = lambda path: op.splitext(op.split(path)[-1])[1][1:]